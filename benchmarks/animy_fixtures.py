@@ -0,0 +1,50 @@
+"""Страницы animy.org для бенчмарков: сохраненные record_fixtures.py или сгенерированные."""
+import glob
+import os
+import re
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixtures(path):
+    """Возвращает содержимое главной страницы и список страниц каталога."""
+    with open(os.path.join(path, 'home.html'), 'rb') as fixture:
+        home_page = fixture.read()
+    page_paths = glob.glob(os.path.join(path, 'releases_page_*.html'))
+    page_paths.sort(key=lambda page_path: int(re.search(r'(\d+)\.html$', page_path).group(1)))
+    catalog_pages = []
+    for page_path in page_paths:
+        with open(page_path, 'rb') as fixture:
+            catalog_pages.append(fixture.read())
+    return home_page, catalog_pages
+
+
+def synthetic_fixtures(page_count, per_page=24):
+    """Генерирует страницы с разметкой, которую ожидают парсеры, и обвязкой сайта."""
+    chrome = ''.join(f'<li class="menu-item"><a href="/genre/{i}">Жанр {i}</a></li>' for i in range(150))
+    scripts = '<script>var config = {};</script>' * 20
+
+    def page(body):
+        return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>animy</title>{scripts}</head>'
+                f'<body><header><ul class="menu">{chrome}</ul></header>{body}<footer>{chrome}</footer></body></html>'
+                ).encode()
+
+    catalog_pages = []
+    for page_num in range(1, page_count + 1):
+        cards = ''.join(
+            f'<a href="https://animy.org/releases/item/anime-{page_num}-{i}"><div class="poster">'
+            f'<img src="https://animy.org/img/{page_num}-{i}.jpg" alt=""></div>'
+            f'<div class="info"><h2> Аниме {page_num}-{i} </h2><span class="year">2024</span></div></a>'
+            for i in range(per_page))
+        pager = ''.join(f'<a href="https://animy.org/releases/page/{num}">{num}</a>'
+                        for num in range(max(1, page_num - 3), min(page_count, page_num + 3) + 1))
+        next_link = '<span class="num_right">&raquo;</span>' if page_num < page_count else ''
+        catalog_pages.append(page(f'<div class="releases-main">{cards}</div><div class="pagination">'
+                                  f'{pager}<a href="https://animy.org/releases/page/{page_count}">{page_count}</a>'
+                                  f'{next_link}</div>'))
+
+    items = ''.join(
+        f'<li><a href="https://animy.org/releases/item/anime-1-{i}/episode-{i}">'
+        f'<img src="https://animy.org/img/1-{i}.jpg"><h2>Аниме 1-{i}</h2><span>Серия {i}</span></a></li>'
+        for i in range(40))
+    return page(f'<div class="list_main_update"><ul>{items}</ul></div>'), catalog_pages
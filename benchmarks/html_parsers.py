@@ -0,0 +1,89 @@
+"""Бенчмарк HTML-парсеров на сохраненных страницах animy.org.
+
+Страницы записываются скриптом record_fixtures.py. Для каждого установленного
+парсера проверяет, что результат совпадает с html.parser, и замеряет время
+разбора страницы каталога и главной страницы. Затем сравнивает разбор всех
+страниц каталога в одном процессе и в пуле процессов, как при полном обходе.
+
+    python benchmarks/record_fixtures.py
+    python benchmarks/html_parsers.py
+
+Без сохраненных страниц можно запустить на сгенерированных (--synthetic N),
+но цифры на реальной разметке будут точнее.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:benchmark')
+os.environ['ANIME_BOT_DB'] = os.path.join(tempfile.mkdtemp(prefix='anime_bot_bench_'), 'bot.db')
+
+import main  # noqa: E402
+from animy_fixtures import FIXTURES_DIR, load_fixtures, synthetic_fixtures  # noqa: E402
+
+
+def measure(func, pages, repeat):
+    """Возвращает медианное время разбора одной страницы в миллисекундах."""
+    timings = []
+    for _ in range(repeat):
+        for content in pages:
+            started_at = time.perf_counter()
+            func(content)
+            timings.append((time.perf_counter() - started_at) * 1000)
+    return statistics.median(timings)
+
+
+def measure_crawl(parser, pages, workers):
+    """Время разбора всех страниц каталога в одном процессе или в пуле."""
+    started_at = time.perf_counter()
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(main.parse_anime_page, pages, [parser] * len(pages)))
+    else:
+        for content in pages:
+            main.parse_anime_page(content, parser)
+    return time.perf_counter() - started_at
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--synthetic', type=int, metavar='PAGES',
+                        help='сгенерировать столько страниц каталога вместо сохраненных')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        home_page, catalog_pages = synthetic_fixtures(args.synthetic)
+    elif os.path.exists(os.path.join(args.fixtures, 'home.html')):
+        home_page, catalog_pages = load_fixtures(args.fixtures)
+    else:
+        sys.exit(f"Нет сохраненных страниц в {args.fixtures}: запустите record_fixtures.py или укажите --synthetic")
+
+    page_size = statistics.mean(len(content) for content in catalog_pages) / 1024
+    print(f"Страниц каталога: {len(catalog_pages)}, средний размер {page_size:.0f} КБ")
+
+    expected_catalog = [main.parse_anime_page(content, 'html.parser') for content in catalog_pages]
+    expected_latest = main.parse_latest_anime(home_page, 'html.parser')
+
+    print(f"{'парсер':<14}{'каталог, мс':>14}{'главная, мс':>14}{'подряд, с':>12}{'пул, с':>10}")
+    for name, backend in main.html_parsers.items():
+        if [backend.parse_anime_page(content) for content in catalog_pages] != expected_catalog \
+                or backend.parse_latest_anime(home_page) != expected_latest:
+            print(f"{name:<14}результат отличается от html.parser")
+            continue
+        catalog_time = measure(backend.parse_anime_page, catalog_pages, args.repeat)
+        home_time = measure(backend.parse_latest_anime, [home_page], args.repeat)
+        sequential_time = measure_crawl(name, catalog_pages, 0)
+        pool_time = measure_crawl(name, catalog_pages, args.workers)
+        print(f"{name:<14}{catalog_time:>14.2f}{home_time:>14.2f}{sequential_time:>12.2f}{pool_time:>10.2f}")
+
+
+if __name__ == '__main__':
+    main_benchmark()
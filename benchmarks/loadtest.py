@@ -0,0 +1,383 @@
+"""Нагрузочный тест бота без внешних сервисов.
+
+Поднимает локальные заменители: HTTP-сервер со страницами animy.org
+(сохраненными record_fixtures.py или сгенерированными), фейковый Bot API
+Telegram и поиск в памяти вместо Elasticsearch. Загружает каталог краулером,
+прогоняет через Application.process_update сценарии синтетических
+пользователей (/start, листание, карточка аниме, подписка, список подписок,
+инлайн-поиск) и рассылку новой серии N подписчикам. Выводит пропускную
+способность и задержки p50/p99 по шагам.
+
+    python benchmarks/loadtest.py --users 200 --subscribers 5000 --save-baseline base.json
+    python benchmarks/loadtest.py --users 200 --subscribers 5000 --baseline base.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:benchmark')
+os.environ['ANIME_BOT_DB'] = os.path.join(tempfile.mkdtemp(prefix='anime_bot_loadtest_'), 'bot.db')
+os.environ['METRICS_PORT'] = '0'
+
+from aiohttp import web  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder  # noqa: E402
+
+import main  # noqa: E402
+from animy_fixtures import FIXTURES_DIR, load_fixtures, synthetic_fixtures  # noqa: E402
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Anime bot", "username": "anime_benchmark_bot"}
+
+
+async def start_site(app):
+    """Запускает aiohttp-приложение на свободном локальном порту и возвращает (runner, адрес)."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    await web.SockSite(runner, sock).start()
+    return runner, "http://127.0.0.1:%s" % sock.getsockname()[1]
+
+
+class FixtureSite:
+    """Отдает главную страницу и /releases/page/N из фикстур с задержкой latency секунд."""
+
+    def __init__(self, home_page, catalog_pages, latency=0.0):
+        self.home_page = home_page
+        self.catalog_pages = catalog_pages
+        self.latency = latency
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_get('/', self.home)
+        self.app.router.add_get('/releases/page/{page_num:\\d+}', self.releases_page)
+
+    async def _respond(self, body):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=body, content_type='text/html', charset='utf-8')
+
+    async def home(self, request):
+        return await self._respond(self.home_page)
+
+    async def releases_page(self, request):
+        page_num = int(request.match_info['page_num'])
+        if not 1 <= page_num <= len(self.catalog_pages):
+            raise web.HTTPNotFound()
+        return await self._respond(self.catalog_pages[page_num - 1])
+
+
+class FakeBotApi:
+    """Отвечает на вызовы Bot API так, как это делает Telegram, не отправляя сообщений.
+
+    Считает вызовы по методам и сообщает о полученных ответах на инлайн-запросы
+    и отправленных уведомлениях, чтобы тест мог замерить их задержку.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.message_id = 0
+        self.inline_answers = {}
+        self.delivered = {}
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    def wait_inline_answer(self, inline_query_id):
+        future = asyncio.get_running_loop().create_future()
+        self.inline_answers[inline_query_id] = future
+        return future
+
+    def _message(self, params):
+        self.message_id += 1
+        chat_id = int(params.get('chat_id', 0))
+        return {"message_id": self.message_id, "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": chat_id, "type": "private"}, "text": params.get('text', '')}
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            result = self._message(params)
+            if method == 'sendMessage':
+                self.delivered[int(params['chat_id'])] = time.perf_counter()
+        else:
+            result = True
+            if method == 'answerInlineQuery':
+                future = self.inline_answers.pop(params.get('inline_query_id'), None)
+                if future is not None and not future.done():
+                    future.set_result(time.perf_counter())
+        return web.json_response({"ok": True, "result": result})
+
+
+class SearchStub:
+    """Заменяет клиент Elasticsearch поиском подстроки по названиям в памяти."""
+
+    def __init__(self, anime_rows):
+        self.documents = [(anime_title.lower(), {"anime_id": anime_id, "anime_title": anime_title,
+                                                 "anime_image": anime_image})
+                          for anime_id, anime_title, anime_image in anime_rows]
+
+    async def search(self, index, size, query, **kwargs):
+        text = query['bool']['must'][0]['match_phrase_prefix']['anime_title']['query']
+        hits = [{"_source": source} for title, source in self.documents if text in title][:size]
+        return {"hits": {"hits": hits}}
+
+    async def close(self):
+        pass
+
+
+class Users:
+    """Строит обновления Telegram от синтетических пользователей."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+    def command(self, user_id, text):
+        update_id = self._next_id()
+        command_length = len(text.split()[0])
+        return Update.de_json({"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": self.user(user_id),
+            "entities": [{"type": "bot_command", "offset": 0, "length": command_length}],
+        }}, self.bot)
+
+    def callback(self, user_id, data):
+        update_id = self._next_id()
+        return Update.de_json({"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self.user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {"message_id": update_id, "date": int(time.time()), "text": "Выберите аниме для подписки:",
+                        "chat": {"id": user_id, "type": "private"}, "from": BOT_USER},
+        }}, self.bot)
+
+    def inline_query(self, user_id, query):
+        update_id = self._next_id()
+        return Update.de_json({"update_id": update_id, "inline_query": {
+            "id": str(update_id), "from": self.user(user_id), "query": query, "offset": "",
+        }}, self.bot)
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(latencies, duration):
+    """Сводка по шагу: число, пропускная способность и задержки в миллисекундах."""
+    values = sorted(latencies)
+    return {"count": len(values), "per_second": len(values) / duration if duration else 0.0,
+            "p50_ms": percentile(values, 0.5) * 1000, "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": values[-1] * 1000}
+
+
+async def run_user(app, users, api, user_id, anime_ids, queries, latencies, inline_timeout):
+    """Сценарий одного пользователя; время каждого шага добавляется в latencies."""
+    anime_id = random.choice(anime_ids)
+    steps = [
+        ('start', users.command(user_id, '/start')),
+        ('next_page', users.callback(user_id, 'page_2')),
+        ('prev_page', users.callback(user_id, 'page_1')),
+        ('show_anime', users.callback(user_id, f'show_anime_{anime_id}_1')),
+        ('subscribe', users.callback(user_id, f'subscribe_{anime_id}')),
+        ('show_subscriptions', users.callback(user_id, 'show_subscriptions')),
+        ('anime_command', users.command(user_id, f'/anime {anime_id}')),
+    ]
+    for name, update in steps:
+        started_at = time.perf_counter()
+        await app.process_update(update)
+        latencies.setdefault(name, []).append(time.perf_counter() - started_at)
+
+    # Инлайн-поиск обрабатывается в фоне, поэтому ждем ответа на стороне Bot API
+    update = users.inline_query(user_id, random.choice(queries))
+    answered = api.wait_inline_answer(update.inline_query.id)
+    started_at = time.perf_counter()
+    await app.process_update(update)
+    try:
+        answered_at = await asyncio.wait_for(answered, inline_timeout)
+    except asyncio.TimeoutError:
+        latencies.setdefault('inline_unanswered', []).append(inline_timeout)
+    else:
+        latencies.setdefault('inline_search', []).append(answered_at - started_at)
+
+
+def find_anime_id(cursor, anime_url):
+    cursor.execute("SELECT anime_id FROM anime WHERE anime_url=?", (anime_url,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+async def run_fanout(bot, api, subscribers, notify_rate, timeout):
+    """Подписывает subscribers пользователей на аниме с главной и замеряет рассылку новой серии."""
+    async with main.CatalogCrawler() as crawler:
+        response = await crawler.fetch(main.animy_url)
+    anime_id = None
+    for episode in main.parse_latest_anime(response.content):
+        anime_id = main.db.read(find_anime_id, main.extract_anime_root_url(episode.episode_url))
+        if anime_id is not None:
+            break
+    if anime_id is None:
+        print("Рассылка пропущена: аниме с главной страницы нет в загруженном каталоге")
+        return None
+
+    def subscribe_all(cursor):
+        cursor.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+                           ((user_id,) for user_id in range(1_000_000, 1_000_000 + subscribers)))
+        cursor.executemany("INSERT OR IGNORE INTO subscriptions (user_id, anime_id) VALUES (?, ?)",
+                           ((user_id, anime_id) for user_id in range(1_000_000, 1_000_000 + subscribers)))
+    main.db.write(subscribe_all)
+
+    main.notification_dispatcher = main.NotificationDispatcher(bot, rate_limit=notify_rate, per_chat_interval=0)
+    main.notification_dispatcher.start()
+    try:
+        started_at = time.perf_counter()
+        await main.FrontPagePoller().poll()
+        enqueued_at = time.perf_counter()
+        deadline = started_at + timeout
+        while time.perf_counter() < deadline:
+            delivered = [at for chat_id, at in api.delivered.items() if chat_id >= 1_000_000]
+            if len(delivered) >= subscribers:
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        await main.notification_dispatcher.stop()
+
+    delivered = [at - started_at for chat_id, at in api.delivered.items() if chat_id >= 1_000_000]
+    print(f"Рассылка: {len(delivered)} из {subscribers} уведомлений, "
+          f"постановка в очередь {(enqueued_at - started_at) * 1000:.0f} мс")
+    if not delivered:
+        return None
+    return summarize(delivered, max(delivered))
+
+
+def print_report(results, baseline=None):
+    print(f"{'шаг':<20}{'число':>8}{'в секунду':>12}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, summary in results.items():
+        line = (f"{name:<20}{summary['count']:>8}{summary['per_second']:>12.1f}{summary['p50_ms']:>10.1f}"
+                f"{summary['p99_ms']:>10.1f}{summary['max_ms']:>10.1f}")
+        base = (baseline or {}).get(name)
+        if base:
+            changes = [(summary[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+                       for key in ('per_second', 'p50_ms', 'p99_ms')]
+            line += "   к базовому: {:+.0f}% в секунду, p50 {:+.0f}%, p99 {:+.0f}%".format(*changes)
+        print(line)
+
+
+async def run(args):
+    if args.synthetic or not os.path.exists(os.path.join(args.fixtures, 'home.html')):
+        home_page, catalog_pages = synthetic_fixtures(args.synthetic or 50)
+    else:
+        home_page, catalog_pages = load_fixtures(args.fixtures)
+
+    fixture_site = FixtureSite(home_page, catalog_pages, args.site_latency / 1000)
+    api = FakeBotApi(args.api_latency / 1000)
+    site_runner, main.animy_url = await start_site(fixture_site.app)
+    api_runner, api_url = await start_site(api.app)
+
+    app = (ApplicationBuilder().token(os.environ['TELEGRAM_BOT_TOKEN']).base_url(f"{api_url}/bot")
+           .updater(None).connection_pool_size(args.concurrency + 8).build())
+    main.add_handlers(app)
+    await app.initialize()
+    await app.start()
+    results = {}
+    try:
+        started_at = time.perf_counter()
+        pages = await main.crawl_anime_catalog()
+        crawl_time = time.perf_counter() - started_at
+        print(f"Каталог: {pages} страниц за {crawl_time:.2f} с ({pages / crawl_time:.1f} страниц/с)")
+
+        anime_rows = main.db.read(main.get_all_anime)
+        if args.search == 'stub':
+            main.search_backend = 'elasticsearch'
+            main.es_async = SearchStub(anime_rows)
+        else:
+            main.search_backend = 'local'
+            main.load_local_search_index()
+        anime_ids = [anime_id for anime_id, _, _ in anime_rows]
+        queries = [anime_title.split()[0].lower() + ' ' + anime_title.split()[-1][:2].lower()
+                   for _, anime_title, _ in random.sample(anime_rows, min(50, len(anime_rows)))]
+
+        latencies = {}
+        semaphore = asyncio.Semaphore(args.concurrency)
+        users = Users(app.bot)
+
+        async def limited_user(user_id):
+            async with semaphore:
+                await run_user(app, users, api, user_id, anime_ids, queries, latencies, args.inline_timeout)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(limited_user(user_id) for user_id in range(10_000, 10_000 + args.users)))
+        duration = time.perf_counter() - started_at
+        total_updates = sum(len(values) for values in latencies.values())
+        print(f"Пользователи: {args.users}, обновлений {total_updates} за {duration:.2f} с "
+              f"({total_updates / duration:.1f} обновлений/с)")
+        results = {name: summarize(values, duration) for name, values in latencies.items()}
+
+        if args.subscribers:
+            fanout = await run_fanout(app.bot, api, args.subscribers, args.notify_rate, args.fanout_timeout)
+            if fanout:
+                results['fanout'] = fanout
+    finally:
+        await main.close_site_crawlers()
+        await app.stop()
+        await app.shutdown()
+        await site_runner.cleanup()
+        await api_runner.cleanup()
+    return results
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100, help='синтетических пользователей')
+    parser.add_argument('--concurrency', type=int, default=50, help='пользователей одновременно')
+    parser.add_argument('--subscribers', type=int, default=1000, help='подписчиков для рассылки, 0 - без нее')
+    parser.add_argument('--notify-rate', type=float, default=main.notify_rate_limit, help='сообщений в секунду')
+    parser.add_argument('--search', choices=['stub', 'local'], default='stub')
+    parser.add_argument('--debounce', type=float, default=main.inline_search_debounce, help='с')
+    parser.add_argument('--site-latency', type=float, default=0.0, help='задержка ответа сайта, мс')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа Bot API, мс')
+    parser.add_argument('--inline-timeout', type=float, default=10.0, help='с')
+    parser.add_argument('--fanout-timeout', type=float, default=600.0, help='с')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--synthetic', type=int, metavar='PAGES', help='сгенерировать страницы каталога')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save-baseline', metavar='PATH', help='сохранить результаты в JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='сравнить с сохраненными результатами')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    main.inline_search_debounce = args.debounce
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(results, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main_benchmark()
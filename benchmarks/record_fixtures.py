@@ -0,0 +1,41 @@
+"""Сохраняет страницы animy.org для бенчмарка HTML-парсеров.
+
+Загружает главную страницу и первые страницы каталога в benchmarks/fixtures:
+
+    python benchmarks/record_fixtures.py --pages 20
+"""
+import argparse
+import os
+import time
+
+import requests
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def save_page(session, url, path):
+    response = session.get(url, timeout=30)
+    response.raise_for_status()
+    with open(path, 'wb') as fixture:
+        fixture.write(response.content)
+    print(f"{url} -> {os.path.relpath(path)} ({len(response.content)} байт)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=20, help='страниц каталога')
+    parser.add_argument('--output', default=FIXTURES_DIR)
+    parser.add_argument('--delay', type=float, default=1.0, help='пауза между запросами, с')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    with requests.Session() as session:
+        save_page(session, "https://animy.org", os.path.join(args.output, 'home.html'))
+        for page_num in range(1, args.pages + 1):
+            time.sleep(args.delay)
+            save_page(session, f"https://animy.org/releases/page/{page_num}",
+                      os.path.join(args.output, f'releases_page_{page_num}.html'))
+
+
+if __name__ == '__main__':
+    main()
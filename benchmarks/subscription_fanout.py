@@ -0,0 +1,106 @@
+"""Бенчмарк выборки подписчиков при рассылке новых серий.
+
+Создает временную базу, заполняет ее подписками на схеме без индексов
+подписок (до миграции 5), замеряет запрос подписчиков аниме и список подписок
+пользователя, затем применяет оставшиеся миграции и повторяет замеры.
+
+    python benchmarks/subscription_fanout.py --subscriptions 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+workdir = tempfile.mkdtemp(prefix='anime_bot_bench_')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:benchmark')
+os.environ['ANIME_BOT_DB'] = os.path.join(workdir, 'bot.db')
+
+import main  # noqa: E402
+
+
+def fill_database(connection, subscriptions, anime_count, user_count, duplicate_ratio):
+    """Заполняет базу аниме, пользователями и подписками (с долей повторов)."""
+    connection.executemany("INSERT INTO anime (anime_title, anime_image, anime_url) VALUES (?, ?, ?)",
+                           ((f"Аниме {i}", f"https://img/{i}.jpg", f"https://animy.org/releases/item/{i}")
+                            for i in range(anime_count)))
+    connection.executemany("INSERT INTO users (user_id) VALUES (?)", ((i,) for i in range(user_count)))
+
+    # Популярность аниме распределена неравномерно, как в реальном каталоге
+    weights = [1 / (rank + 1) for rank in range(anime_count)]
+    anime_ids = random.choices(range(1, anime_count + 1), weights=weights, k=subscriptions)
+    rows = [(random.randrange(user_count), anime_id) for anime_id in anime_ids]
+    rows += random.sample(rows, int(len(rows) * duplicate_ratio))
+    connection.executemany("INSERT INTO subscriptions (user_id, anime_id) VALUES (?, ?)", rows)
+    connection.commit()
+    return len(rows)
+
+
+def measure(func, args_list):
+    """Возвращает медиану и p99 времени выполнения в миллисекундах."""
+    timings = []
+    for args in args_list:
+        started_at = time.perf_counter()
+        func(*args)
+        timings.append((time.perf_counter() - started_at) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def run_queries(connection, anime_ids, user_ids):
+    cursor = connection.cursor()
+
+    def fanout(anime_id):
+        cursor.execute("SELECT user_id FROM subscriptions WHERE anime_id=?", (anime_id,))
+        return cursor.fetchall()
+
+    return {
+        'подписчики аниме': measure(fanout, [(anime_id,) for anime_id in anime_ids]),
+        'подписки пользователя': measure(lambda user_id: main.list_subscriptions(cursor, user_id),
+                                         [(user_id,) for user_id in user_ids]),
+    }
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscriptions', type=int, default=1_000_000)
+    parser.add_argument('--anime', type=int, default=5_000)
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--duplicates', type=float, default=0.01, help='доля повторных подписок')
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(42)
+    connection = sqlite3.connect(os.path.join(workdir, 'fanout.db'))
+    connection.execute("PRAGMA journal_mode=WAL")
+    cursor = connection.cursor()
+    main.migrate_schema(cursor, target_version=4)
+
+    started_at = time.perf_counter()
+    rows = fill_database(connection, args.subscriptions, args.anime, args.users, args.duplicates)
+    print(f"Подписок: {rows} (заполнение {time.perf_counter() - started_at:.1f} с)")
+
+    anime_ids = random.choices(range(1, args.anime + 1), k=args.queries)
+    user_ids = random.choices(range(args.users), k=args.queries)
+    before = run_queries(connection, anime_ids, user_ids)
+
+    started_at = time.perf_counter()
+    version = main.migrate_schema(cursor)
+    migration_time = time.perf_counter() - started_at
+    remaining = connection.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+    print(f"Миграция до версии {version}: {migration_time:.1f} с, осталось подписок {remaining}")
+
+    after = run_queries(connection, anime_ids, user_ids)
+
+    print(f"{'запрос':<24}{'до: p50 / p99, мс':>22}{'после: p50 / p99, мс':>24}")
+    for name in before:
+        print(f"{name:<24}{before[name][0]:>10.3f} / {before[name][1]:<9.3f}"
+              f"{after[name][0]:>12.3f} / {after[name][1]:<9.3f}")
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -1,111 +1,716 @@
 import hashlib
-
-import requests
+import hmac
+import json
+import multiprocessing
+import random
+import secrets
+import signal
+import socket
+
+import httpx
 import threading
 import time
+import urllib.parse
 from bs4 import BeautifulSoup
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, \
     InputTextMessageContent, InlineQueryResultPhoto
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, InlineQueryHandler, \
     ChosenInlineResultHandler
 import sqlite3
 import os
 import logging
 import asyncio
+import datetime
+import functools
+import queue
 import re
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Elasticsearch
-from elasticsearch import Elasticsearch
+from elasticsearch import AsyncElasticsearch, Elasticsearch, helpers
+
+# Быстрые HTML-парсеры необязательны: без них страницы разбирает html.parser
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+try:
+    import lxml.html as lxml_html
+except ImportError:
+    lxml_html = None
+
+es_url = os.environ.get('ES_URL', "http://localhost:9200")
+
+# Имя пользователя и пароль Elasticsearch; без них клиент подключается без авторизации
+username = os.environ.get('ES_USERNAME')
+password = os.environ.get('ES_PASSWORD')
+es_auth = {'basic_auth': (username, password)} if username and password else {}
 
-es_url = "http://localhost:9200"
+# Основной поисковый движок: elasticsearch (с локальным индексом как запасным) или local
+search_backend = os.environ.get('SEARCH_BACKEND', 'elasticsearch')
 
-# Укажите имя пользователя и пароль
-username = "stastest"
-password = "test123"
+es_index = "anime"  # алиас, через который ищет бот
+es_bulk_chunk_size = int(os.environ.get('ES_BULK_CHUNK_SIZE', 500))
+# Полная переиндексация с переключением алиаса при ближайшем обновлении каталога (также /refresh reindex)
+es_full_reindex_requested = os.environ.get('ES_FULL_REINDEX', '') == '1'
 
 # Создайте объект клиента Elasticsearch
 es = Elasticsearch(
     [es_url],
-    basic_auth=(username, password)
+    **es_auth
 )
+# Асинхронный клиент для поиска из обработчиков бота
+es_async = AsyncElasticsearch(
+    [es_url],
+    **es_auth
+)
+
+# Настройки краулера каталога
+animy_url = os.environ.get('ANIMY_URL', "https://animy.org").rstrip('/')  # адрес сайта (для тестов - локальный сервер)
+crawler_concurrency = int(os.environ.get('CRAWLER_CONCURRENCY', 8))  # одновременных запросов
+crawler_rate_limit = float(os.environ.get('CRAWLER_RATE_LIMIT', 10))  # запросов в секунду на хост
+crawler_retries = int(os.environ.get('CRAWLER_RETRIES', 3))
+crawler_backoff = float(os.environ.get('CRAWLER_BACKOFF', 1.0))  # базовая задержка между повторами, с
+crawler_timeout = float(os.environ.get('CRAWLER_TIMEOUT', 30.0))  # с, на один запрос
+page_load_timeout = float(os.environ.get('PAGE_LOAD_TIMEOUT', 10.0))  # с, загрузка страницы по запросу пользователя
+page_load_retries = int(os.environ.get('PAGE_LOAD_RETRIES', 1))
+catalog_full_refresh_interval = int(os.environ.get('CATALOG_FULL_REFRESH_INTERVAL', 24 * 3600))  # с
+catalog_incremental_max_pages = int(os.environ.get('CATALOG_INCREMENTAL_MAX_PAGES', 10))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+html_parser = os.environ.get('HTML_PARSER', 'auto')  # selectolax, lxml, html.parser или auto (самый быстрый из доступных)
+parse_workers = int(os.environ.get('PARSE_WORKERS', os.cpu_count() or 1))  # процессов для разбора страниц при полном обходе, 0 - без пула
+
+# Настройки рассылки уведомлений
+notify_workers = int(os.environ.get('NOTIFY_WORKERS', 16))  # параллельных отправок
+notify_rate_limit = float(os.environ.get('NOTIFY_RATE_LIMIT', 30))  # сообщений в секунду на бота
+notify_per_chat_interval = float(os.environ.get('NOTIFY_PER_CHAT_INTERVAL', 1.0))  # с между сообщениями в чат
+notify_max_attempts = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 5))
+notify_batch_size = int(os.environ.get('NOTIFY_BATCH_SIZE', 200))  # уведомлений, забираемых из базы за раз
+notify_lease = 600  # с, через сколько незавершенная отправка считается прерванной
+notify_retry_backoff = 30  # с, базовая задержка перед повтором при сетевой ошибке
+notify_poll_interval = 60  # с, как часто проверять очередь без сигнала от проверки обновлений
+notify_sent_retention = 7 * 24 * 3600  # с, сколько хранить отправленные уведомления
+RELEASES_PAGE_RE = re.compile(r'/releases/page/(\d+)')
+
+# Настройки фоновых задач
+update_check_interval = int(os.environ.get('UPDATE_CHECK_INTERVAL', 300))  # с, проверка новых эпизодов на главной
+update_check_active_interval = int(os.environ.get('UPDATE_CHECK_ACTIVE_INTERVAL', 90))  # с, в часы выхода серий
+update_check_max_interval = int(os.environ.get('UPDATE_CHECK_MAX_INTERVAL', 1800))  # с, предел роста интервала
+update_check_backoff = 1.5  # во сколько раз растет интервал после проверки без новых эпизодов
+# Часы выхода серий по времени сервера, например "10-14,18-2"
+release_active_hours = [tuple(int(hour) for hour in hours.split('-'))
+                        for hours in os.environ.get('RELEASE_ACTIVE_HOURS', '').split(',') if hours.strip()]
+catalog_update_interval = int(os.environ.get('CATALOG_UPDATE_INTERVAL', 3500))  # с, обновление каталога
+job_jitter = 0.1  # случайное отклонение интервала задачи, доля
+job_retry_backoff = 60  # с, задержка перед повтором задачи после первой ошибки
+job_max_backoff = 3600  # с, максимальная задержка повтора
+admin_user_ids = {int(user_id) for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+
+# Настройки инлайн-поиска
+search_cache_size = int(os.environ.get('SEARCH_CACHE_SIZE', 5000))  # запросов в кэше
+search_cache_ttl = int(os.environ.get('SEARCH_CACHE_TTL', 600))  # с
+inline_search_debounce = float(os.environ.get('INLINE_SEARCH_DEBOUNCE', 0.3))  # с
+inline_cache_time = int(os.environ.get('INLINE_CACHE_TIME', 300))  # с, кэш результатов на стороне Telegram
+# Telegram принимает не больше 50 результатов в одном ответе на инлайн-запрос
+inline_page_size = min(50, int(os.environ.get('INLINE_PAGE_SIZE', 20)))
+search_result_limit = int(os.environ.get('SEARCH_RESULT_LIMIT', 200))  # результатов на запрос, листаемых по страницам
+
+# Режим работы: polling (один процесс) или webhook (несколько процессов на одном порту)
+bot_mode = os.environ.get('BOT_MODE', 'polling')
+webhook_url = os.environ.get('WEBHOOK_URL', '')  # публичный HTTPS-адрес, например https://bot.example.com/telegram
+webhook_listen = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')  # TLS завершает обратный прокси перед ботом
+webhook_port = int(os.environ.get('WEBHOOK_PORT', 8443))
+webhook_secret = os.environ.get('WEBHOOK_SECRET', '')  # пустой - сгенерировать при запуске
+webhook_max_connections = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))  # соединений Telegram к вебхуку
+webhook_max_body = 1024 * 1024  # байт, предел размера обновления
+bot_workers = int(os.environ.get('BOT_WORKERS', os.cpu_count() or 1))  # процессов в режиме webhook
+leader_lease_ttl = 30  # с, через сколько без продления ведущий процесс считается упавшим
+search_index_refresh_interval = int(os.environ.get('SEARCH_INDEX_REFRESH_INTERVAL', 600))  # с, в ведомых процессах
+
+# Настройки базы данных
+db_path = os.environ.get('ANIME_BOT_DB', 'anime_bot.db')
+db_readers = int(os.environ.get('DB_READERS', 4))  # соединений для чтения
+anime_cache_size = int(os.environ.get('ANIME_CACHE_SIZE', 10000))  # аниме в памяти для обработчиков
+
+# Метрики в формате Prometheus, 0 - не запускать сервер метрик
+metrics_host = os.environ.get('METRICS_HOST', '127.0.0.1')
+metrics_port = int(os.environ.get('METRICS_PORT', 9464))
+
 # Настройка логирования
 logging.basicConfig(filename='anime_bot.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     encoding='utf-8')
 
+# --- Метрики ---
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # с
+
+
+class CounterMetric:
+    """Счетчик событий с метками."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        """Возвращает пары (метки, значение)."""
+        with self._lock:
+            return list(self._values.items())
+
+
+class GaugeMetric(CounterMetric):
+    """Текущее значение величины с метками."""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class HistogramMetric:
+    """Гистограмма длительностей с фиксированными границами корзин."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Счетчики по корзинам (последняя - +Inf), сумма и количество
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Замеряет время выполнения блока with."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, *labels)
+
+    def samples(self):
+        """Возвращает тройки (метки, счетчики по корзинам, сумма, количество)."""
+        with self._lock:
+            return [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+
+    def quantile(self, q, *labels):
+        """Оценка квантиля по верхней границе корзины, None без наблюдений."""
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None or series[2] == 0:
+                return None
+            rank = q * series[2]
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[0]):
+                seen += count
+                if seen >= rank:
+                    return bound
+        return float('inf')
+
+
+class MetricsRegistry:
+    """Набор метрик бота, отдаваемый в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.metrics = []
+        self.started_at = time.time()
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(CounterMetric(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(GaugeMetric(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(HistogramMetric(name, documentation, labelnames, buckets))
+
+    @staticmethod
+    def _format_labels(labelnames, labels, extra=()):
+        pairs = list(zip(labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{name}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """Возвращает все метрики в текстовом формате Prometheus."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if metric.kind != 'histogram':
+                for labels, value in metric.samples():
+                    lines.append(f"{metric.name}{self._format_labels(metric.labelnames, labels)} {value}")
+                continue
+            for labels, counts, total, count in metric.samples():
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    bucket_labels = self._format_labels(metric.labelnames, labels, [('le', bound)])
+                    lines.append(f"{metric.name}_bucket{bucket_labels} {cumulative}")
+                series_labels = self._format_labels(metric.labelnames, labels)
+                lines.append(f"{metric.name}_sum{series_labels} {total}")
+                lines.append(f"{metric.name}_count{series_labels} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram('animebot_handler_seconds', 'Время обработки обновления Telegram', ['handler'])
+handler_errors = metrics.counter('animebot_handler_errors_total', 'Исключения в обработчиках Telegram', ['handler'])
+http_request_seconds = metrics.histogram('animebot_http_request_seconds', 'Время запроса к animy.org', ['target'])
+http_requests = metrics.counter('animebot_http_requests_total', 'Запросы к animy.org по статусу ответа',
+                                ['target', 'status'])
+db_query_seconds = metrics.histogram('animebot_db_seconds', 'Время выполнения функции доступа к базе',
+                                     ['function'])
+db_wait_seconds = metrics.histogram('animebot_db_wait_seconds', 'Ожидание свободного соединения с базой', ['mode'])
+search_seconds = metrics.histogram('animebot_search_seconds', 'Время поискового запроса', ['backend'])
+search_errors = metrics.counter('animebot_search_errors_total', 'Ошибки поискового движка', ['backend'])
+notifications = metrics.counter('animebot_notifications_total', 'Попытки отправки уведомлений по результату',
+                                ['result'])
+notification_seconds = metrics.histogram('animebot_notification_send_seconds', 'Время отправки уведомления')
+notification_backlog = metrics.gauge('animebot_notification_outbox', 'Уведомления в очереди по статусу',
+                                     ['status'])
+webhook_requests = metrics.counter('animebot_webhook_requests_total', 'Запросы к вебхуку по HTTP-статусу',
+                                   ['status'])
+job_runs = metrics.counter('animebot_job_runs_total', 'Запуски фоновых задач по результату', ['job', 'result'])
+job_seconds = metrics.histogram('animebot_job_seconds', 'Время выполнения фоновой задачи', ['job'])
+
+
+def http_target(url):
+    """Метка запроса: первый сегмент пути (releases, root для главной)."""
+    return httpx.URL(url).path.strip('/').split('/')[0] or 'root'
+
+
+def instrument_handler(handler):
+    """Оборачивает обработчик Telegram, записывая время обработки и исключения."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started_at = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started_at, name)
+
+    return wrapper
+
+
+async def serve_metrics(reader, writer):
+    """Отвечает на GET /metrics метриками в формате Prometheus."""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # заголовки запроса не нужны
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            await update_outbox_metrics()
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    """Запускает локальный HTTP-сервер метрик, если задан порт."""
+    if not metrics_port:
+        return None
+    server = await asyncio.start_server(serve_metrics, metrics_host, metrics_port)
+    logging.info("Метрики доступны на http://%s:%s/metrics", metrics_host, metrics_port)
+    return server
+
+
+# --- База данных ---
+
+class Database:
+    """Доступ к SQLite: одно соединение для записи и пул соединений для чтения.
+
+    База работает в режиме WAL, поэтому читатели не ждут запись. Запись идет
+    через единственное соединение под блокировкой и фиксируется по выходу из
+    writer(). Функции доступа принимают курсор первым аргументом: read/write
+    выполняют их в текущем потоке (для фоновых задач), aread/awrite - в
+    отдельных пулах потоков для чтения и записи, не блокируя цикл событий
+    бота. Каждое соединение кэширует подготовленные выражения, поэтому
+    запросы с постоянным текстом SQL компилируются один раз.
+    """
+
+    def __init__(self, path, readers=db_readers):
+        self.path = path
+        self._writer = self._connect()
+        self._write_lock = threading.Lock()
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect())
+        # У записи свой поток: ожидание блокировки записи не занимает потоки читателей
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-read')
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        # WAL позволяет читать базу во время записи, а synchronous=NORMAL убирает fsync на каждый коммит
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        return connection
+
+    @contextmanager
+    def reader(self):
+        """Выдает свободное соединение для чтения."""
+        with db_wait_seconds.time('read'):
+            connection = self._readers.get()
+        try:
+            yield connection
+        finally:
+            self._readers.put(connection)
+
+    @contextmanager
+    def writer(self):
+        """Выдает соединение для записи и фиксирует транзакцию, а при ошибке откатывает ее."""
+        with db_wait_seconds.time('write'):
+            self._write_lock.acquire()
+        try:
+            yield self._writer
+            self._writer.commit()
+        except BaseException:
+            self._writer.rollback()
+            raise
+        finally:
+            self._write_lock.release()
+
+    def read(self, func, *args):
+        """Выполняет func(курсор, *args) на соединении для чтения."""
+        with self.reader() as connection, db_query_seconds.time(func.__name__):
+            return func(connection.cursor(), *args)
+
+    def write(self, func, *args):
+        """Выполняет func(курсор, *args) одной транзакцией на соединении для записи."""
+        with self.writer() as connection, db_query_seconds.time(func.__name__):
+            return func(connection.cursor(), *args)
+
+    async def aread(self, func, *args):
+        """То же, что read, но в пуле потоков для чтения."""
+        return await asyncio.get_running_loop().run_in_executor(self._read_executor, self.read, func, *args)
+
+    async def awrite(self, func, *args):
+        """То же, что write, но в отдельном потоке для записи."""
+        return await asyncio.get_running_loop().run_in_executor(self._write_executor, self.write, func, *args)
+
+
+# --- Миграции схемы ---
+
+def add_column_if_missing(cursorThread, table, column, column_type):
+    """Добавляет колонку, если ее еще нет (базы, созданные до появления миграций)."""
+    columns = {row[1] for row in cursorThread.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cursorThread.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def migration_initial_schema(cursorThread):
+    """Исходные таблицы бота."""
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS users (
+                        user_id INTEGER PRIMARY KEY
+                    )''')
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS anime (
+                        anime_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        anime_title TEXT,
+                        anime_image TEXT,
+                        anime_url TEXT UNIQUE
+                    )''')
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS episodes (
+                        episode_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        episode_hash TEXT UNIQUE,
+                        anime_id INTEGER,
+                        episode_url TEXT UNIQUE,
+                        FOREIGN KEY (anime_id) REFERENCES anime(anime_id)
+                    )''')
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS subscriptions (
+                        subscription_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        anime_id INTEGER,
+                        FOREIGN KEY (user_id) REFERENCES users(user_id),
+                        FOREIGN KEY (anime_id) REFERENCES anime(anime_id)
+                    )''')
+
+
+def migration_catalog_cache(cursorThread):
+    """Кэш страниц каталога: позиция аниме на сайте и валидаторы для условных запросов."""
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS catalog_pages (
+                        page_num INTEGER PRIMARY KEY,
+                        has_next_page INTEGER NOT NULL,
+                        fetched_at INTEGER NOT NULL
+                    )''')
+    add_column_if_missing(cursorThread, 'catalog_pages', 'etag', 'TEXT')
+    add_column_if_missing(cursorThread, 'catalog_pages', 'last_modified', 'TEXT')
+    add_column_if_missing(cursorThread, 'catalog_pages', 'content_hash', 'TEXT')
+    add_column_if_missing(cursorThread, 'anime', 'catalog_page', 'INTEGER')
+    add_column_if_missing(cursorThread, 'anime', 'catalog_index', 'INTEGER')
+    cursorThread.execute("CREATE INDEX IF NOT EXISTS idx_anime_catalog ON anime (catalog_page, catalog_index)")
+
+
+def migration_notification_outbox(cursorThread):
+    """Очередь уведомлений о новых сериях: строки создаются в одной транзакции с эпизодом."""
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS notification_outbox (
+                        outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        episode_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        next_attempt_at INTEGER NOT NULL,
+                        last_error TEXT,
+                        sent_at INTEGER,
+                        UNIQUE (episode_id, user_id),
+                        FOREIGN KEY (episode_id) REFERENCES episodes(episode_id),
+                        FOREIGN KEY (user_id) REFERENCES users(user_id)
+                    )''')
+    cursorThread.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox (status, next_attempt_at)")
+
+
+def migration_search_index_state(cursorThread):
+    """Хеш содержимого, проиндексированного в Elasticsearch, для отправки только изменений."""
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS search_index_state (
+                        anime_id INTEGER PRIMARY KEY,
+                        content_hash TEXT NOT NULL,
+                        FOREIGN KEY (anime_id) REFERENCES anime(anime_id)
+                    )''')
+
+
+def migration_subscription_indexes(cursorThread):
+    """Индексы и ограничения для рассылки и списка подписок.
+
+    Перед созданием UNIQUE(user_id, anime_id) удаляются повторные подписки
+    (остается самая ранняя), а пользователи, которые есть только в подписках,
+    добавляются в users.
+    """
+    cursorThread.execute('''INSERT OR IGNORE INTO users (user_id)
+                            SELECT DISTINCT user_id FROM subscriptions WHERE user_id IS NOT NULL''')
+    cursorThread.execute('''DELETE FROM subscriptions WHERE subscription_id NOT IN (
+                                SELECT MIN(subscription_id) FROM subscriptions GROUP BY user_id, anime_id)''')
+    deleted = cursorThread.rowcount
+    if deleted:
+        logging.info("Удалено повторных подписок: %s", deleted)
+    # Уникальный индекс обслуживает и список подписок пользователя (поиск по user_id)
+    cursorThread.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_user_anime
+                            ON subscriptions (user_id, anime_id)''')
+    # Покрывающий индекс для выборки подписчиков аниме при рассылке
+    cursorThread.execute('''CREATE INDEX IF NOT EXISTS idx_subscriptions_anime_user
+                            ON subscriptions (anime_id, user_id)''')
+    cursorThread.execute("CREATE INDEX IF NOT EXISTS idx_episodes_anime ON episodes (anime_id)")
+
+
+def migration_leader_lease(cursorThread):
+    """Аренда роли ведущего процесса, который обходит сайт и рассылает уведомления."""
+    cursorThread.execute('''CREATE TABLE IF NOT EXISTS leader_lease (
+                        name TEXT PRIMARY KEY,
+                        holder TEXT NOT NULL,
+                        expires_at REAL NOT NULL
+                    )''')
+
+
+# Миграции применяются по порядку, номер последней примененной хранится в PRAGMA user_version.
+# Первые миграции идемпотентны: базы, созданные до их появления, имеют user_version 0.
+MIGRATIONS = [
+    (1, migration_initial_schema),
+    (2, migration_catalog_cache),
+    (3, migration_notification_outbox),
+    (4, migration_search_index_state),
+    (5, migration_subscription_indexes),
+    (6, migration_leader_lease),
+]
+
+
+def migrate_schema(cursorThread, target_version=None):
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает версию схемы."""
+    cursorThread.execute("PRAGMA user_version")
+    version = cursorThread.fetchone()[0]
+    for migration_version, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        if target_version is not None and migration_version > target_version:
+            break
+        logging.info("Применяется миграция схемы %s: %s", migration_version, migration.__name__)
+        cursorThread.execute("BEGIN")
+        migration(cursorThread)
+        cursorThread.execute(f"PRAGMA user_version = {migration_version:d}")
+        cursorThread.connection.commit()
+        version = migration_version
+    return version
+
+
+AnimeRecord = namedtuple('AnimeRecord', ['anime_id', 'anime_title', 'anime_image'])
+AnimeRecord.__doc__ = "Название и картинка аниме."
+
+
+def get_anime(cursorThread, anime_id):
+    """Получает аниме по id. Возвращает AnimeRecord или None."""
+    cursorThread.execute("SELECT anime_id, anime_title, anime_image FROM anime WHERE anime_id=?", (anime_id,))
+    result = cursorThread.fetchone()
+    return AnimeRecord(*result) if result else None
+
+
+def add_user(cursorThread, user_id):
+    """Регистрирует пользователя, если его еще нет."""
+    cursorThread.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+
+
+def add_subscription(cursorThread, user_id, anime_id):
+    """Подписывает пользователя на аниме. При повторной подписке бросает sqlite3.IntegrityError."""
+    cursorThread.execute("INSERT INTO subscriptions (user_id, anime_id) VALUES (?, ?)", (user_id, anime_id))
+
+
+def list_subscriptions(cursorThread, user_id):
+    """Возвращает названия аниме, на которые подписан пользователь."""
+    cursorThread.execute('''SELECT anime.anime_title FROM anime
+                            INNER JOIN subscriptions ON anime.anime_id = subscriptions.anime_id
+                            WHERE subscriptions.user_id=?''', (user_id,))
+    return [row[0] for row in cursorThread.fetchall()]
+
+
 # Инициализация базы данных
-conn = sqlite3.connect('anime_bot.db', check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY
-                )''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS anime (
-                    anime_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    anime_title TEXT,
-                    anime_image TEXT,
-                    anime_url TEXT UNIQUE
-                )''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS episodes (
-                    episode_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    episode_hash TEXT UNIQUE,
-                    anime_id INTEGER,
-                    episode_url TEXT UNIQUE,
-                    FOREIGN KEY (anime_id) REFERENCES anime(anime_id)
-                )''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS subscriptions (
-                    subscription_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    anime_id INTEGER,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (anime_id) REFERENCES anime(anime_id)
-                )''')
-conn.commit()
+db = Database(db_path)
+db.write(migrate_schema)
 
-# Инициализация бота
-bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-if not bot_token:
-    print("Ошибка: переменная окружения TELEGRAM_BOT_TOKEN не установлена.")
-    exit(1)
-application = ApplicationBuilder().token(bot_token).build()
 
+class AnimeCache:
+    """Ограниченный LRU-кэш AnimeRecord по anime_id.
+
+    Названия и картинки меняются только при обходе каталога, поэтому
+    обработчики читают их отсюда, а краулер обновляет закэшированные записи
+    после сохранения страниц. В процессах, которые не обходят каталог, записи
+    обновляются вместе с локальным поиском (refresh_local_search_index).
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, anime_id):
+        with self._lock:
+            anime = self._records.get(anime_id)
+            if anime is not None:
+                self._records.move_to_end(anime_id)
+            return anime
+
+    def put(self, anime):
+        with self._lock:
+            self._records[anime.anime_id] = anime
+            self._records.move_to_end(anime.anime_id)
+            while len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+
+    def update(self, anime_list):
+        """Обновляет уже закэшированные аниме по списку (название, картинка, anime_id)."""
+        with self._lock:
+            for anime_title, anime_image, anime_id in anime_list:
+                if anime_id in self._records:
+                    self._records[anime_id] = AnimeRecord(anime_id, anime_title, anime_image)
+
+
+anime_cache = AnimeCache(anime_cache_size)
+
+
+async def get_anime_cached(anime_id):
+    """Получает аниме по id из кэша, а при промахе из базы. Возвращает AnimeRecord или None."""
+    anime = anime_cache.get(anime_id)
+    if anime is None:
+        anime = await db.aread(get_anime, anime_id)
+        if anime is not None:
+            anime_cache.put(anime)
+    return anime
+
+
+def publish_stored_anime(anime_list):
+    """Передает сохраненные краулером аниме в кэш и локальный поисковый индекс."""
+    anime_cache.update(anime_list)
+    local_search_index.update(anime_list)
 
 # --- Функции бота ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start. Показывает первую страницу аниме."""
     user_id = update.effective_user.id
-    cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-    conn.commit()
+    await db.awrite(add_user, user_id)
 
     logging.info("Пользователь %s запустил бота", user_id)
-    context.user_data['current_page'] = 1
-    anime_data, has_next_page = get_anime_data(cursor, 1)
-    await show_anime_options(update, context, anime_data, has_next_page)
+    await show_anime_page(update, context, 1)
 
     keyboard = [[InlineKeyboardButton("Мои подписки", callback_data="show_subscriptions")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.effective_message.reply_text("Управление подписками:", reply_markup=reply_markup)
 
 
-async def show_anime_options(update: Update, context: ContextTypes.DEFAULT_TYPE, anime_data, has_next_page):
-    """Показывает кнопки с аниме."""
+async def show_anime_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page_num):
+    """Загружает страницу каталога и показывает ее кнопками."""
+    anime_data, has_next_page = await load_anime_page(page_num)
+    await show_anime_options(update, context, anime_data, has_next_page, page_num)
+
+
+async def show_anime_options(update: Update, context: ContextTypes.DEFAULT_TYPE, anime_data, has_next_page,
+                             current_page=1):
+    """Показывает кнопки с аниме.
+
+    Номер страницы передается в callback_data кнопок, а не хранится в
+    user_data, поэтому нажатие может обработать любой процесс бота.
+    """
     keyboard = []
-    current_page = context.user_data.get('current_page', 1)
 
     for i in range(0, len(anime_data), 3):
         row = []
         # Изменено: убран anime_hash из цикла
         for title, image, anime_id in anime_data[i:i + 3]:
-            callback_data = f"show_anime_{anime_id}"  # Используем anime_id в callback_data
-            logging.info("Кнопка для аниме %s с ID %s", title, anime_id)
+            callback_data = f"show_anime_{anime_id}_{current_page}"  # anime_id и страница, на которую вернуться
+            logging.debug("Кнопка для аниме %s с ID %s", title, anime_id)
             title_button = title[:45] + '...' if len(title) > 45 else title
             row.append(InlineKeyboardButton(title_button, callback_data=callback_data))
         keyboard.append(row)
 
     keyboard.append([
-        InlineKeyboardButton("⬅️ Назад", callback_data="prev_page" if current_page > 1 else "disabled"),
+        InlineKeyboardButton("⬅️ Назад", callback_data=f"page_{current_page - 1}" if current_page > 1 else "disabled"),
         InlineKeyboardButton(f"Страница {current_page}", callback_data="disabled"),
-        InlineKeyboardButton("➡️ Вперед", callback_data="next_page" if has_next_page else "disabled")
+        InlineKeyboardButton("➡️ Вперед", callback_data=f"page_{current_page + 1}" if has_next_page else "disabled")
     ])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -134,11 +739,10 @@ async def button_clicked(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.info("Пользователь %s нажал кнопку подписки с ID %s", user_id, anime_id)
 
         try:
-            cursor.execute("INSERT INTO subscriptions (user_id, anime_id) VALUES (?, ?)", (user_id, anime_id))
-            conn.commit()
-            anime_title = get_anime_title_by_id(anime_id)
+            await db.awrite(add_subscription, user_id, anime_id)
+            anime = await get_anime_cached(anime_id)
             await context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text=f"Вы успешно подписались на {anime_title}!")
+                                           text=f"Вы успешно подписались на {anime.anime_title}!")
         except sqlite3.IntegrityError:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text="Вы уже подписаны на это аниме.")
@@ -149,41 +753,36 @@ async def button_clicked(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data == "show_subscriptions":
         await show_subscriptions(update, context)
-    elif data == "back_to_list":
-        context.user_data['current_page'] = context.user_data.get('current_page', 1)
-        anime_data, has_next_page = get_anime_data(cursor, context.user_data['current_page'])
+    elif data.startswith("back_to_list"):
+        page_num = int(data[len("back_to_list_"):] or 1)
         await query.message.delete()
-        await show_anime_options(update, context, anime_data, has_next_page)
-    elif data == "prev_page":
-        context.user_data['current_page'] = max(1, context.user_data.get('current_page', 1) - 1)
-        anime_data, has_next_page = get_anime_data(cursor, context.user_data['current_page'])
-        await show_anime_options(update, context, anime_data, has_next_page)
-    elif data == "next_page":
-        context.user_data['current_page'] = context.user_data.get('current_page', 1) + 1
-        anime_data, has_next_page = get_anime_data(cursor, context.user_data['current_page'])
-        await show_anime_options(update, context, anime_data, has_next_page)
+        await show_anime_page(update, context, page_num)
+    elif data.startswith("page_"):
+        await show_anime_page(update, context, max(1, int(data[len("page_"):])))
+    elif data in ("prev_page", "next_page"):
+        # Кнопки из старых сообщений без номера страницы ведут в начало каталога
+        await show_anime_page(update, context, 1)
     elif data.startswith("show_anime_"):
-        anime_id = int(data[len("show_anime_"):])  # Используем anime_id
-        await show_anime_details(update, context, anime_id)
+        anime_id, _, page_num = data[len("show_anime_"):].partition('_')  # Используем anime_id
+        await show_anime_details(update, context, int(anime_id), int(page_num or 1))
 
 
-async def show_anime_details(update: Update, context: ContextTypes.DEFAULT_TYPE, anime_id):  # Изменено: anime_id вместо anime_hash
+async def show_anime_details(update: Update, context: ContextTypes.DEFAULT_TYPE, anime_id, page_num=1):  # Изменено: anime_id вместо anime_hash
     """Показывает детали аниме: картинку, название и кнопку подписки."""
-    anime_title = get_anime_title_by_id(anime_id)  # Используем anime_id
-    anime_image = get_anime_image_by_id(anime_id)  # Используем anime_id
+    anime = await get_anime_cached(anime_id)  # Используем anime_id
     bot = context.bot
 
-    if anime_title and anime_image:
+    if anime and anime.anime_title and anime.anime_image:
         keyboard = [
             [InlineKeyboardButton("Подписаться", callback_data=f"subscribe_{anime_id}")],  # Используем anime_id
-            [InlineKeyboardButton("Назад", callback_data="back_to_list")]
+            [InlineKeyboardButton("Назад", callback_data=f"back_to_list_{page_num}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         await bot.send_photo(
             chat_id=update.effective_chat.id,
-            photo=anime_image,
-            caption=anime_title,
+            photo=anime.anime_image,
+            caption=anime.anime_title,
             reply_markup=reply_markup
         )
     else:
@@ -195,224 +794,1407 @@ async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     logging.info("Пользователь %s запросил список подписок", user_id)
 
-    cursor.execute('''SELECT anime.anime_title FROM anime
-                      INNER JOIN subscriptions ON anime.anime_id = subscriptions.anime_id
-                      WHERE subscriptions.user_id=?''', (user_id,))
-
-    subscriptions = cursor.fetchall()
+    subscriptions = await db.aread(list_subscriptions, user_id)
 
     if subscriptions:
-        subscriptions_text = "\n".join([f"- {row[0]}" for row in subscriptions])
+        subscriptions_text = "\n".join([f"- {anime_title}" for anime_title in subscriptions])
         await update.effective_message.reply_text(f"Ваши подписки:\n{subscriptions_text}")
     else:
         await update.effective_message.reply_text("У вас нет активных подписок.")
 
 
-def get_anime_data(cursorThread, page_num=1):
-    """Получает данные об аниме с указанной страницы."""
-    base_url = f"https://animy.org/releases/page/{page_num}"
-    response = requests.get(base_url)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.content, 'html.parser')
-
+def store_anime_page(cursorThread, page_num, anime_entries, has_next_page,
+                     etag=None, last_modified=None, content_hash=None):
+    """Сохраняет страницу каталога в базу и возвращает список (название, картинка, anime_id)."""
     anime_list = []
-    for anime_div in soup.find_all('div', class_='releases-main'):
-        for anime_data in anime_div.find_all('a'):
-            anime_title = anime_data.find('h2').text.strip()
-            anime_image = anime_data.find('img')['src']
-            anime_url = anime_data["href"]
+    for catalog_index, (anime_title, anime_image, anime_url) in enumerate(anime_entries):
+        try:
+            # Вставляем аниме или обновляем название, картинку и позицию в каталоге
+            cursorThread.execute('''INSERT INTO anime (anime_title, anime_image, anime_url, catalog_page, catalog_index)
+                                    VALUES (?, ?, ?, ?, ?)
+                                    ON CONFLICT(anime_url) DO UPDATE SET
+                                        anime_title=excluded.anime_title,
+                                        anime_image=excluded.anime_image,
+                                        catalog_page=excluded.catalog_page,
+                                        catalog_index=excluded.catalog_index
+                                    RETURNING anime_id''',
+                                 (anime_title, anime_image, anime_url, page_num, catalog_index))
+            anime_id = cursorThread.fetchone()[0]
+            anime_list.append((anime_title, anime_image, anime_id))
 
-            try:
-                # Вставляем данные в таблицу anime
-                cursorThread.execute("INSERT OR IGNORE INTO anime (anime_title, anime_image, anime_url) VALUES (?, ?, ?)",
-                                     (anime_title, anime_image, anime_url))
-                conn.commit()
-
-                if cursorThread.rowcount > 0: # Проверяем, была ли выполнена вставка
-                    # Вставка произошла, получаем last_insert_rowid()
-                    cursorThread.execute("SELECT last_insert_rowid()")
-                    anime_id = cursorThread.fetchone()[0]
-                else:
-                    # Вставка не произошла, получаем anime_id по другим данным
-                    cursorThread.execute("SELECT anime_id FROM anime WHERE anime_title=? AND anime_url=?", (anime_title, anime_url))
-                    anime_id = cursorThread.fetchone()[0]
+        except Exception as e:
+            logging.error(f"Ошибка при добавлении аниме в базу данных: {e}")
 
-                anime_list.append((anime_title, anime_image, anime_id))
+    # Аниме, которые ушли с этой страницы, больше не должны на ней показываться
+    page_ids = [anime_id for _, _, anime_id in anime_list]
+    cursorThread.execute(
+        f"UPDATE anime SET catalog_page=NULL, catalog_index=NULL "
+        f"WHERE catalog_page=? AND anime_id NOT IN ({','.join('?' * len(page_ids))})",
+        (page_num, *page_ids))
+    cursorThread.execute('''INSERT OR REPLACE INTO catalog_pages
+                            (page_num, has_next_page, fetched_at, etag, last_modified, content_hash)
+                            VALUES (?, ?, ?, ?, ?, ?)''',
+                         (page_num, int(has_next_page), int(time.time()), etag, last_modified, content_hash))
+    return anime_list
 
-            except Exception as e:
-                logging.error(f"Ошибка при добавлении аниме в базу данных: {e}")
 
-    has_next_page = soup.find('span', class_='num_right') is not None
-    return anime_list, has_next_page
+def get_catalog_page_validators(cursorThread):
+    """Возвращает {номер страницы: (ETag, Last-Modified, хеш содержимого, есть ли следующая страница)}."""
+    cursorThread.execute("SELECT page_num, etag, last_modified, content_hash, has_next_page FROM catalog_pages")
+    return {page_num: (etag, last_modified, content_hash, bool(has_next_page))
+            for page_num, etag, last_modified, content_hash, has_next_page in cursorThread.fetchall()}
+
+
+def touch_catalog_page(cursorThread, page_num):
+    """Отмечает, что страница каталога проверена и не изменилась."""
+    cursorThread.execute("UPDATE catalog_pages SET fetched_at=? WHERE page_num=?", (int(time.time()), page_num))
+
+
+def count_known_anime_urls(cursorThread, anime_urls):
+    """Считает, сколько из переданных ссылок уже есть в таблице anime."""
+    if not anime_urls:
+        return 0
+    cursorThread.execute(
+        f"SELECT COUNT(*) FROM anime WHERE anime_url IN ({','.join('?' * len(anime_urls))})",
+        tuple(anime_urls))
+    return cursorThread.fetchone()[0]
+
+
+def get_cached_anime_page(cursorThread, page_num=1):
+    """Получает страницу каталога из базы.
+
+    Возвращает None, если страница еще не загружалась с сайта или помечена
+    устаревшей (invalidate_catalog_pages_after).
+    """
+    cursorThread.execute("SELECT has_next_page FROM catalog_pages WHERE page_num=? AND content_hash IS NOT NULL",
+                         (page_num,))
+    page = cursorThread.fetchone()
+    if page is None:
+        return None
+
+    cursorThread.execute('''SELECT anime_title, anime_image, anime_id FROM anime
+                            WHERE catalog_page=? ORDER BY catalog_index''', (page_num,))
+    return cursorThread.fetchall(), bool(page[0])
+
+
+def clear_catalog_pages_after(cursorThread, last_page_num):
+    """Удаляет из кэша каталога страницы, которых больше нет на сайте."""
+    cursorThread.execute("UPDATE anime SET catalog_page=NULL, catalog_index=NULL WHERE catalog_page>?",
+                         (last_page_num,))
+    cursorThread.execute("DELETE FROM catalog_pages WHERE page_num>?", (last_page_num,))
+
+
+def invalidate_catalog_pages_after(cursorThread, last_page_num):
+    """Помечает устаревшими страницы каталога после указанной, чтобы они загрузились с сайта заново.
+
+    Строки страниц остаются, и полный обход по-прежнему знает, сколько страниц
+    в каталоге. Сбрасываются только валидаторы: без хеша содержимого страница
+    не отдается из кэша, а обход запрашивает ее без условных заголовков.
+    Позиции аниме перезапишутся при повторной загрузке страницы.
+    """
+    cursorThread.execute("UPDATE catalog_pages SET etag=NULL, last_modified=NULL, content_hash=NULL WHERE page_num>?",
+                         (last_page_num,))
+
+
+async def load_anime_page(page_num=1):
+    """Отдает страницу каталога из базы, а при холодном кэше загружает ее с сайта."""
+    cached_page = await db.aread(get_cached_anime_page, page_num)
+    if cached_page is not None:
+        return cached_page
+
+    logging.info("Страница каталога %s отсутствует в кэше, загружаем с сайта", page_num)
+    page = await get_page_crawler().fetch_anime_page(page_num)
+    anime_list = await db.awrite(store_anime_page, page_num, page.anime_entries, page.has_next_page,
+                                 page.etag, page.last_modified, page.content_hash)
+    publish_stored_anime(anime_list)
+    return anime_list, page.has_next_page
+
 
+# --- Разбор страниц animy.org ---
 
-# Удалены функции get_anime_title_by_hash и get_anime_image_by_hash
+AnimeEntry = namedtuple('AnimeEntry', ['anime_title', 'anime_image', 'anime_url'])
+AnimeEntry.__doc__ = "Карточка аниме со страницы каталога."
 
-def get_anime_title_by_id(anime_id):
-    """Получает название аниме по id."""
-    cursor.execute("SELECT anime_title FROM anime WHERE anime_id=?", (anime_id,))
-    result = cursor.fetchone()
-    return result[0] if result else None
+ParsedCatalogPage = namedtuple('ParsedCatalogPage', ['anime_entries', 'has_next_page', 'last_page_num'])
+ParsedCatalogPage.__doc__ = "Результат разбора страницы каталога."
 
+LatestEpisode = namedtuple('LatestEpisode', ['anime_title', 'anime_image', 'episode_hash', 'episode_url'])
+LatestEpisode.__doc__ = "Эпизод из блока последних обновлений на главной странице."
 
-def get_anime_image_by_id(anime_id):
-    """Получает изображение аниме по ID."""
-    cursor.execute("SELECT anime_image FROM anime WHERE anime_id=?", (anime_id,))
-    result = cursor.fetchone()
-    return result[0] if result else None
 
+def collect_catalog_page(cards, has_next_page, page_links):
+    """Собирает результат разбора каталога из извлеченных парсером данных.
 
-def get_latest_anime():
-    """Получает последние аниме серии с главной страницы сайта."""
-    base_url = "https://animy.org"
-    response = requests.get(base_url)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.content, 'html.parser')
+    cards - кортежи (название, картинка, ссылка), где отсутствующее поле равно
+    None; такие карточки пропускаются. page_links - ссылки страницы, из которых
+    берется номер последней страницы пагинатора.
+    """
+    anime_entries = []
+    for anime_title, anime_image, anime_url in cards:
+        if anime_title is None or anime_image is None or anime_url is None:
+            logging.error(f"Ошибка при разборе карточки аниме: нет названия, картинки или ссылки ({anime_url})")
+            continue
+        anime_entries.append(AnimeEntry(anime_title, anime_image, anime_url))
 
+    page_numbers = [int(match.group(1)) for href in page_links if (match := RELEASES_PAGE_RE.search(href))]
+    last_page_num = max(page_numbers) if page_numbers else None
+    return ParsedCatalogPage(anime_entries, has_next_page, last_page_num)
+
+
+def collect_latest_episodes(items):
+    """Собирает эпизоды с главной страницы, пропуская неполные и повторы."""
     latest_anime_list = []
     seen_hashes = set()
+    for anime_title, anime_image, episode_url in items:
+        if anime_title is None or anime_image is None or episode_url is None:
+            logging.error(f"Ошибка при разборе эпизода на главной странице: {episode_url}")
+            continue
+        episode_hash = hashlib.md5(episode_url.encode()).hexdigest()
+
+        # Проверяем, был ли уже добавлен такой эпизод по хешу
+        if episode_hash not in seen_hashes:
+            latest_anime_list.append(LatestEpisode(anime_title, anime_image, episode_hash, episode_url))
+            seen_hashes.add(episode_hash)
+    return latest_anime_list
+
+
+def parse_anime_page_bs4(content, features='html.parser'):
+    soup = BeautifulSoup(content, features)
+    cards = []
+    for anime_div in soup.find_all('div', class_='releases-main'):
+        for anime_data in anime_div.find_all('a'):
+            title = anime_data.find('h2')
+            image = anime_data.find('img')
+            cards.append((title.text.strip() if title else None,
+                          image.get('src') if image else None,
+                          anime_data.get('href')))
+    has_next_page = soup.find('span', class_='num_right') is not None
+    return collect_catalog_page(cards, has_next_page, (link['href'] for link in soup.find_all('a', href=True)))
+
+
+def parse_latest_anime_bs4(content, features='html.parser'):
+    soup = BeautifulSoup(content, features)
+    items = []
     releases_section = soup.find('div', class_='list_main_update')
     if releases_section:
         for anime_data in releases_section.find_all('li'):
-            anime_url = anime_data.find('a')['href']
-            anime_title = anime_data.find('h2').text.strip()
-            anime_image = anime_data.find('img')['src']
-            episode_hash = hashlib.md5(anime_url.encode()).hexdigest()
+            link = anime_data.find('a')
+            title = anime_data.find('h2')
+            image = anime_data.find('img')
+            items.append((title.text.strip() if title else None,
+                          image.get('src') if image else None,
+                          link.get('href') if link else None))
+    return collect_latest_episodes(items)
 
-            # Проверяем, был ли уже добавлен такой эпизод по хешу
-            if episode_hash not in seen_hashes:
-                latest_anime_list.append((anime_title, anime_image, episode_hash, anime_url))
-                seen_hashes.add(episode_hash)
 
-    return latest_anime_list
+def lxml_has_class(class_name):
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
 
 
-def extract_anime_root_url(episode_url):
-    """Извлекает корень URL аниме из ссылки на эпизод."""
-    match = re.match(r'(https://animy\.org/releases/item/[^/]+)', episode_url)
-    return match.group(0) if match else None
+def lxml_first(node, tag):
+    return next(node.iter(tag), None)
 
 
-def check_updates_and_notify():
-    cursorThread = conn.cursor()
-    """Проверяет обновления на сайте и отправляет уведомления подписчикам."""
-    while True:
-        logging.info("Проверка новых эпизодов на сайте...")
-        latest_anime = get_latest_anime()
-        new_episodes = []
+def parse_anime_page_lxml(content):
+    tree = lxml_html.fromstring(content)
+    cards = []
+    for anime_data in tree.xpath(f'//div[{lxml_has_class("releases-main")}]//a'):
+        title = lxml_first(anime_data, 'h2')
+        image = lxml_first(anime_data, 'img')
+        cards.append((title.text_content().strip() if title is not None else None,
+                      image.get('src') if image is not None else None,
+                      anime_data.get('href')))
+    has_next_page = bool(tree.xpath(f'//span[{lxml_has_class("num_right")}]'))
+    return collect_catalog_page(cards, has_next_page, tree.xpath('//a/@href'))
 
-        for title, image, episode_hash, episode_url in latest_anime:
-            anime_root_url = extract_anime_root_url(episode_url)
 
-            if not anime_root_url:
-                continue
+def parse_latest_anime_lxml(content):
+    tree = lxml_html.fromstring(content)
+    items = []
+    releases_section = tree.xpath(f'(//div[{lxml_has_class("list_main_update")}])[1]')
+    if releases_section:
+        for anime_data in releases_section[0].iter('li'):
+            link = lxml_first(anime_data, 'a')
+            title = lxml_first(anime_data, 'h2')
+            image = lxml_first(anime_data, 'img')
+            items.append((title.text_content().strip() if title is not None else None,
+                          image.get('src') if image is not None else None,
+                          link.get('href') if link is not None else None))
+    return collect_latest_episodes(items)
+
+
+def parse_anime_page_selectolax(content):
+    tree = SelectolaxParser(content)
+    cards = []
+    for anime_data in tree.css('div.releases-main a'):
+        title = anime_data.css_first('h2')
+        image = anime_data.css_first('img')
+        cards.append((title.text().strip() if title is not None else None,
+                      image.attributes.get('src') if image is not None else None,
+                      anime_data.attributes.get('href')))
+    has_next_page = tree.css_first('span.num_right') is not None
+    return collect_catalog_page(cards, has_next_page,
+                                (link.attributes.get('href') or '' for link in tree.css('a[href]')))
+
+
+def parse_latest_anime_selectolax(content):
+    tree = SelectolaxParser(content)
+    items = []
+    releases_section = tree.css_first('div.list_main_update')
+    if releases_section is not None:
+        for anime_data in releases_section.css('li'):
+            link = anime_data.css_first('a')
+            title = anime_data.css_first('h2')
+            image = anime_data.css_first('img')
+            items.append((title.text().strip() if title is not None else None,
+                          image.attributes.get('src') if image is not None else None,
+                          link.attributes.get('href') if link is not None else None))
+    return collect_latest_episodes(items)
+
+
+DIV_TAG_RE = re.compile(rb'<(/?)div\b[^>]*>', re.IGNORECASE)
+
+
+def extract_div_section(content, class_name):
+    """Вырезает из HTML первый div с указанным классом вместе со вложенными div.
+
+    Работает по байтам без построения дерева, чтобы дешево сравнивать блок
+    страницы между загрузками. Возвращает None, если такого div нет.
+    """
+    class_re = re.compile(rb'<div\b[^>]*\bclass\s*=\s*["\'][^"\']*(?<![\w-])'
+                          + re.escape(class_name.encode()) + rb'(?![\w-])', re.IGNORECASE)
+    match = class_re.search(content)
+    if match is None:
+        return None
+    depth = 0
+    for tag in DIV_TAG_RE.finditer(content, match.start()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return content[match.start():tag.end()]
+    return content[match.start():]
+
+
+HtmlParserBackend = namedtuple('HtmlParserBackend', ['parse_anime_page', 'parse_latest_anime'])
+
+html_parsers = {'html.parser': HtmlParserBackend(parse_anime_page_bs4, parse_latest_anime_bs4)}
+if lxml_html is not None:
+    html_parsers['lxml'] = HtmlParserBackend(parse_anime_page_lxml, parse_latest_anime_lxml)
+if SelectolaxParser is not None:
+    html_parsers['selectolax'] = HtmlParserBackend(parse_anime_page_selectolax, parse_latest_anime_selectolax)
+
+
+def get_html_parser(name=None):
+    """Возвращает парсер по имени; auto - самый быстрый из установленных."""
+    name = name or html_parser
+    if name == 'auto':
+        name = next(name for name in ('selectolax', 'lxml', 'html.parser') if name in html_parsers)
+    if name not in html_parsers:
+        logging.warning("HTML-парсер %s недоступен, используем html.parser", name)
+        name = 'html.parser'
+    return html_parsers[name]
+
+
+def parse_anime_page(content, parser=None):
+    """Разбирает страницу каталога.
+
+    Возвращает ParsedCatalogPage: список AnimeEntry, признак следующей страницы
+    и номер последней страницы из пагинатора (None, если его нет). Функция не
+    обращается к базе и сети, поэтому ее можно выполнять в пуле процессов.
+    """
+    return get_html_parser(parser).parse_anime_page(content)
+
+
+def parse_latest_anime(content, parser=None):
+    """Разбирает главную страницу и возвращает список LatestEpisode без повторов."""
+    return get_html_parser(parser).parse_latest_anime(content)
+
+
+# --- Краулер каталога ---
+
+CatalogPage = namedtuple('CatalogPage', [
+    'page_num', 'anime_entries', 'has_next_page', 'last_page_num',
+    'etag', 'last_modified', 'content_hash', 'not_modified',
+], defaults=(None, None, None, False))
+CatalogPage.__doc__ = "Страница каталога, загруженная краулером."
+
+
+class HostRateLimiter:
+    """Ограничивает частоту запросов к одному хосту."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        """Ждет, пока не освободится следующий слот для запроса."""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class CatalogCrawler:
+    """Асинхронный краулер каталога animy.org с пулом соединений.
+
+    Сначала загружает первую страницу и узнает из пагинатора номер последней,
+    затем качает остальные страницы параллельно, не больше `concurrency`
+    запросов одновременно и не чаще `rate_limit` запросов в секунду на хост.
+    Если в crawl передан `parse_executor` (пул процессов), страницы
+    разбираются в нем, а не в цикле событий.
+    """
+
+    def __init__(self, concurrency=crawler_concurrency, rate_limit=crawler_rate_limit,
+                 retries=crawler_retries, backoff=crawler_backoff, timeout=crawler_timeout):
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiters = {}
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            follow_redirects=True,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def _limiter(self, url):
+        host = httpx.URL(url).host
+        if host not in self._limiters:
+            self._limiters[host] = HostRateLimiter(self.rate_limit)
+        return self._limiters[host]
+
+    async def fetch(self, url, headers=None):
+        """Загружает страницу с повторами и экспоненциальной задержкой при ошибках."""
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            async with self._semaphore:
+                await self._limiter(url).wait()
+                try:
+                    with http_request_seconds.time(http_target(url)):
+                        response = await self._client.get(url, headers=headers)
+                    http_requests.inc(http_target(url), str(response.status_code))
+                    if response.status_code == 304:
+                        return response
+                    if response.status_code not in RETRYABLE_STATUSES:
+                        response.raise_for_status()
+                        return response
+                    retry_after = response.headers.get('Retry-After')
+                    error = httpx.HTTPStatusError(f"HTTP {response.status_code}",
+                                                  request=response.request, response=response)
+                except httpx.TransportError as e:
+                    http_requests.inc(http_target(url), type(e).__name__)
+                    error = e
+
+            if attempt == self.retries:
+                raise error
+            delay = self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logging.warning("Ошибка загрузки %s (%s), повтор через %.1f с", url, error, delay)
+            await asyncio.sleep(delay)
+
+    async def fetch_anime_page(self, page_num, validators=None, parse_executor=None):
+        """Загружает и разбирает страницу каталога.
+
+        Если переданы валидаторы прошлой загрузки (get_catalog_page_validators),
+        отправляет условный запрос и не разбирает страницу, когда она не изменилась.
+        Такая страница приходит с not_modified и has_next_page из прошлой загрузки.
+        """
+        etag, last_modified, content_hash, has_next_page = validators or (None, None, None, False)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response = await self.fetch(f"{animy_url}/releases/page/{page_num}", headers=headers)
+        if response.status_code == 304:
+            return CatalogPage(page_num, [], has_next_page, None, etag, last_modified, content_hash, True)
+
+        new_hash = hashlib.md5(response.content).hexdigest()
+        new_etag = response.headers.get('ETag')
+        new_last_modified = response.headers.get('Last-Modified')
+        if new_hash == content_hash:
+            return CatalogPage(page_num, [], has_next_page, None, new_etag, new_last_modified, new_hash, True)
+
+        if parse_executor is None:
+            parsed_page = parse_anime_page(response.content)
+        else:
+            parsed_page = await asyncio.get_running_loop().run_in_executor(
+                parse_executor, parse_anime_page, response.content)
+        anime_entries, has_next_page, last_page_num = parsed_page
+        return CatalogPage(page_num, anime_entries, has_next_page, last_page_num,
+                           new_etag, new_last_modified, new_hash)
+
+    async def _fetch_anime_page_safe(self, page_num, validators=None, parse_executor=None):
+        try:
+            return await self.fetch_anime_page(page_num, validators, parse_executor)
+        except Exception as e:
+            logging.error(f"Не удалось загрузить страницу каталога {page_num}: {e}")
+            return None
+
+    async def crawl(self, page_validators=None, parse_executor=None):
+        """Загружает весь каталог.
+
+        Номер последней страницы берется из пагинатора первой страницы (или из
+        прошлого обхода, если она не изменилась), и страницы до него качаются
+        параллельно. Пагинатор может показывать только часть страниц, поэтому,
+        пока у последней загруженной страницы есть ссылка на следующую, обход
+        продолжается следующей пачкой до номера из ее пагинатора.
+
+        Возвращает список CatalogPage и признак того, что каталог загружен
+        целиком: все страницы загрузились без ошибок, а у последней нет
+        следующей. Неизменившиеся страницы приходят с not_modified.
+        """
+        page_validators = page_validators or {}
+        first_page = await self.fetch_anime_page(1, page_validators.get(1), parse_executor)
+        pages = [first_page]
+        if first_page.not_modified:
+            # Первая страница не изменилась: берем границы каталога из прошлого обхода
+            last_page_num = max(page_validators)
+        else:
+            last_page_num = first_page.last_page_num
+
+        complete = True
+        last_page = first_page
+        while last_page.has_next_page:
+            # Если номер последней страницы неизвестен, следующая пачка - одна страница
+            next_page_num = last_page.page_num + 1
+            results = await asyncio.gather(
+                *(self._fetch_anime_page_safe(page_num, page_validators.get(page_num), parse_executor)
+                  for page_num in range(next_page_num, max(last_page_num or 0, next_page_num) + 1)))
+            complete = complete and all(page is not None for page in results)
+            pages.extend(page for page in results if page is not None)
+            last_page = results[-1]
+            if last_page is None:
+                return pages, False
+            last_page_num = last_page.last_page_num
+        return pages, complete
+
+    async def crawl_new(self, page_validators, is_page_known, max_pages=catalog_incremental_max_pages):
+        """Загружает только начало каталога, где появляются новые релизы.
+
+        Идет по страницам с первой и останавливается, как только страница не
+        изменилась или все аниме на ней уже есть в базе (корутина is_page_known).
+        """
+        pages = []
+        for page_num in range(1, max_pages + 1):
+            page = await self.fetch_anime_page(page_num, page_validators.get(page_num))
+            pages.append(page)
+            if page.not_modified or not page.has_next_page or await is_page_known(page):
+                break
+        return pages
+
+
+background_crawler = None
+page_crawler = None
+
+
+def get_background_crawler():
+    """Возвращает краулер фоновых задач, создавая его при первом обращении.
+
+    Опрос главной страницы и обновления каталога идут через один клиент:
+    соединения с сайтом переиспользуются между запусками задач, а лимит
+    запросов на хост общий для всех задач.
+    """
+    global background_crawler
+    if background_crawler is None:
+        background_crawler = CatalogCrawler()
+    return background_crawler
+
+
+def get_page_crawler():
+    """Возвращает краулер для страниц каталога, которые загружаются по запросу пользователя.
+
+    Он отделен от фоновых задач, чтобы показ страницы не ждал в очереди полного
+    обхода, и делает меньше повторов с коротким таймаутом: пользователь ждет ответа.
+    """
+    global page_crawler
+    if page_crawler is None:
+        page_crawler = CatalogCrawler(retries=page_load_retries, timeout=page_load_timeout)
+    return page_crawler
+
+
+async def close_site_crawlers():
+    """Закрывает соединения краулеров фоновых задач и страниц по запросу."""
+    global background_crawler, page_crawler
+    for crawler in (background_crawler, page_crawler):
+        if crawler is not None:
+            await crawler.aclose()
+    background_crawler = page_crawler = None
+
+
+def save_catalog_pages(cursorThread, pages, incremental=False):
+    """Сохраняет загруженные краулером страницы каталога. Возвращает сохраненные аниме.
+
+    При инкрементальном обновлении новые релизы сдвигают остальные аниме
+    дальше по каталогу, поэтому если хоть одна страница изменилась, кэш
+    следующих за ней страниц сбрасывается и они загрузятся заново при показе.
+    """
+    stored_anime = []
+    changed = False
+    for page in pages:
+        if page.not_modified:
+            touch_catalog_page(cursorThread, page.page_num)
+        else:
+            stored_anime += store_anime_page(cursorThread, page.page_num, page.anime_entries, page.has_next_page,
+                                             page.etag, page.last_modified, page.content_hash)
+            changed = True
+    if incremental and changed:
+        invalidate_catalog_pages_after(cursorThread, pages[-1].page_num)
+    return stored_anime
+
+
+async def crawl_anime_catalog():
+    """Полностью обновляет каталог аниме в базе. Возвращает количество загруженных страниц."""
+    started_at = time.monotonic()
+    page_validators = await db.aread(get_catalog_page_validators)
+    if parse_workers > 0:
+        # Разбор HTML нагружает процессор и держит GIL, поэтому при полном обходе он идет в отдельных процессах
+        with ProcessPoolExecutor(max_workers=parse_workers) as parse_executor:
+            pages, complete = await get_background_crawler().crawl(page_validators, parse_executor)
+    else:
+        pages, complete = await get_background_crawler().crawl(page_validators)
+
+    # Весь обход сохраняется одной транзакцией
+    stored_anime = await db.awrite(save_catalog_pages, pages)
+    publish_stored_anime(stored_anime)
+    if complete:
+        await db.awrite(clear_catalog_pages_after, max(page.page_num for page in pages))
+
+    changed = sum(not page.not_modified for page in pages)
+    logging.info("Каталог загружен: %s страниц (изменилось %s) за %.1f с",
+                 len(pages), changed, time.monotonic() - started_at)
+    return len(pages)
+
+
+async def refresh_new_anime():
+    """Инкрементально обновляет каталог: загружает страницы, пока на них есть новые аниме."""
+    started_at = time.monotonic()
+
+    async def is_page_known(page):
+        anime_urls = [url for _, _, url in page.anime_entries]
+        return await db.aread(count_known_anime_urls, anime_urls) == len(anime_urls)
+
+    pages = await get_background_crawler().crawl_new(await db.aread(get_catalog_page_validators), is_page_known)
+
+    stored_anime = await db.awrite(save_catalog_pages, pages, True)
+    publish_stored_anime(stored_anime)
+    logging.info("Инкрементальное обновление каталога: %s страниц за %.1f с",
+                 len(pages), time.monotonic() - started_at)
+    return len(pages)
 
-            cursorThread.execute("SELECT 1 FROM episodes WHERE episode_hash=?", (episode_hash,))
-            if cursorThread.fetchone() is None:
-                cursorThread.execute("SELECT anime_id FROM anime WHERE anime_url=?", (anime_root_url,))
-                result = cursorThread.fetchone()
-                if result:
-                    anime_id = result[0]
-                    new_episodes.append((episode_hash, anime_id, episode_url))
 
+def extract_anime_root_url(episode_url):
+    """Извлекает корень URL аниме из ссылки на эпизод.
+
+    Хост не проверяется: ссылки сравниваются с anime_url из каталога в том виде,
+    в каком их отдает сайт, в том числе зеркало или локальный сервер из ANIMY_URL.
+    """
+    match = re.match(r'(https?://[^/]+/releases/item/[^/]+)', episode_url)
+    return match.group(0) if match else None
+
+
+def find_new_episodes(cursorThread, latest_anime):
+    """Отбирает с главной страницы эпизоды, которых еще нет в базе.
+
+    Возвращает список (episode_hash, anime_id, episode_url).
+    """
+    latest_rows = []
+    for title, image, episode_hash, episode_url in latest_anime:
+        anime_root_url = extract_anime_root_url(episode_url)
+        if anime_root_url:
+            latest_rows.append((len(latest_rows), episode_hash, anime_root_url, episode_url))
+    if not latest_rows:
+        return []
+
+    # Все эпизоды страницы сверяются с базой одним запросом
+    values = ", ".join(["(?, ?, ?, ?)"] * len(latest_rows))
+    cursorThread.execute(f'''WITH latest (position, episode_hash, anime_url, episode_url) AS (VALUES {values})
+                             SELECT latest.episode_hash, anime.anime_id, latest.episode_url
+                             FROM latest JOIN anime ON anime.anime_url = latest.anime_url
+                             WHERE NOT EXISTS (SELECT 1 FROM episodes WHERE episodes.episode_hash = latest.episode_hash)
+                             ORDER BY latest.position''',
+                         [value for row in latest_rows for value in row])
+    return cursorThread.fetchall()
+
+
+def add_episodes(cursorThread, new_episodes):
+    """Сохраняет новые эпизоды и ставит в очередь уведомления их подписчикам.
+
+    Эпизоды и уведомления записываются одной транзакцией, поэтому после
+    перезапуска рассылка продолжится с того же места.
+    """
+    now = int(time.time())
+    for episode_hash, anime_id, url in new_episodes:
+        cursorThread.execute(
+            "INSERT INTO episodes (episode_hash, anime_id, episode_url) VALUES (?, ?, ?) RETURNING episode_id",
+            (episode_hash, anime_id, url))
+        episode_id = cursorThread.fetchone()[0]
+        cursorThread.execute('''INSERT OR IGNORE INTO notification_outbox (episode_id, user_id, next_attempt_at)
+                                SELECT ?, user_id, ? FROM subscriptions WHERE anime_id=?''',
+                             (episode_id, now, anime_id))
+
+
+def in_active_hours(hour_ranges, hour=None):
+    """Проверяет, попадает ли час (по умолчанию текущий) в один из интервалов [начало, конец)."""
+    hour = datetime.datetime.now().hour if hour is None else hour
+    for start_hour, end_hour in hour_ranges:
+        if start_hour <= end_hour:
+            if start_hour <= hour < end_hour:
+                return True
+        elif hour >= start_hour or hour < end_hour:  # интервал через полночь, например 22-2
+            return True
+    return False
+
+
+class FrontPagePoller:
+    """Опрашивает блок последних обновлений на главной странице.
+
+    В часы выхода серий главная проверяется каждые active_interval секунд,
+    в остальное время - каждые interval. Пока новых эпизодов нет, интервал
+    растет в backoff раз за каждую пустую проверку, но не больше interval в
+    активные часы и max_interval в остальное время. Если хеш блока
+    list_main_update не изменился с прошлой проверки, страница не разбирается.
+    """
+
+    def __init__(self, interval=update_check_interval, active_interval=update_check_active_interval,
+                 max_interval=update_check_max_interval, backoff=update_check_backoff,
+                 active_hours=release_active_hours):
+        self.interval = interval
+        self.active_interval = active_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.active_hours = active_hours
+        self.section_hash = None
+        self.idle_polls = 0
+
+    def next_interval(self):
+        """Интервал до следующей проверки в секундах."""
+        if in_active_hours(self.active_hours):
+            base_interval, max_interval = self.active_interval, self.interval
+        else:
+            base_interval, max_interval = self.interval, self.max_interval
+        return min(max_interval, base_interval * self.backoff ** self.idle_polls)
+
+    async def poll(self):
+        """Проверяет обновления на сайте и ставит в очередь уведомления подписчикам."""
+        response = await get_background_crawler().fetch(animy_url)
+        section = extract_div_section(response.content, 'list_main_update')
+        if section is None:
+            logging.warning("Блок list_main_update не найден на главной странице")
+            section = response.content
+
+        section_hash = hashlib.md5(section).hexdigest()
+        if section_hash == self.section_hash:
+            self.idle_polls += 1
+            logging.debug("Главная страница не изменилась, следующая проверка через %.0f с", self.next_interval())
+            return
+
+        new_episodes = await db.aread(find_new_episodes, parse_latest_anime(section))
         if new_episodes:
             logging.info(f"Новые эпизоды найдены: {len(new_episodes)} эпизодов.")
-            cursorThread.executemany(
-                "INSERT INTO episodes (episode_hash, anime_id, episode_url) VALUES (?, ?, ?)",
-                new_episodes)
-            conn.commit()
-
-            for episode_hash, anime_id, url in new_episodes:
-                cursorThread.execute('''SELECT user_id FROM subscriptions
-                                  WHERE anime_id=?''', (anime_id,))
-                subscribers = cursorThread.fetchall()
-                for (user_id,) in subscribers:
-                    anime_title = get_anime_title_by_id(anime_id)
-                    try:
-                        asyncio.run(application.bot.send_message(chat_id=user_id,
-                                                                text=f"Новая серия: {anime_title}\n{url}"))
-                    except Exception as e:
-                        logging.error(e)
+            await db.awrite(add_episodes, new_episodes)
+            notification_dispatcher.wake()
+            self.idle_polls = 0
+        else:
+            self.idle_polls += 1
+        # Хеш запоминается только после записи, чтобы при ошибке блок разобрали снова
+        self.section_hash = section_hash
+
 
-        time.sleep(3600)  # ждем 1 час
+front_page_poller = FrontPagePoller()
 
 
-def update_anime_database():
-    cursorThread = conn.cursor()
-    """Обновляет базу данных аниме раз в час."""
-    while True:
-        logging.info("Обновление базы данных аниме...")
-        page_num = 1
-        has_next_page = True
+last_full_catalog_refresh = 0.0
 
-        while has_next_page:
-            anime_data, has_next_page = get_anime_data(cursorThread, page_num)
-            page_num += 1
 
+async def update_anime_database():
+    """Обновляет базу данных аниме.
+
+    Обычно загружаются только первые страницы с новыми релизами, полный обход
+    каталога выполняется раз в catalog_full_refresh_interval секунд. Если
+    запрошена полная переиндексация Elasticsearch (ES_FULL_REINDEX или
+    /refresh reindex), индекс строится заново, иначе отправляются только
+    изменившиеся аниме.
+    """
+    global last_full_catalog_refresh, es_full_reindex_requested
+    logging.info("Обновление базы данных аниме...")
+    if time.time() - last_full_catalog_refresh >= catalog_full_refresh_interval:
+        await crawl_anime_catalog()
+        last_full_catalog_refresh = time.time()
+    else:
+        await refresh_new_anime()
+
+    if search_backend == 'elasticsearch':
         logging.info("Updating ElasticSearch...")
-        index_anime_data()
+        full_reindex, es_full_reindex_requested = es_full_reindex_requested, False
+        try:
+            await asyncio.to_thread(index_anime_data, full_reindex)
+        except Exception as e:
+            logging.error(f"Ошибка при индексации в Elasticsearch: {e}")
+            # Неудавшаяся полная переиндексация повторяется при следующем обновлении
+            es_full_reindex_requested = es_full_reindex_requested or full_reindex
         logging.info("Finished update of ElasticSearch...")
 
-        logging.info("База данных аниме обновлена.")
-        time.sleep(3500)  # ждем 1 час
+    logging.info("База данных аниме обновлена.")
+
+
+# --- Планировщик фоновых задач ---
+
+class ScheduledJob:
+    """Периодическая задача на очереди заданий бота.
+
+    Каждый запуск планирует следующий через interval секунд (или через
+    значение interval(), если это функция) со случайным отклонением на
+    jitter долю интервала, поэтому задачи не выстраиваются в одно время.
+    Два запуска одной задачи никогда не выполняются одновременно.
+    Исключение не останавливает задачу: следующая попытка откладывается с
+    экспоненциальной задержкой от retry_backoff до max_backoff секунд.
+    """
+
+    def __init__(self, name, func, interval, jitter=job_jitter,
+                 retry_backoff=job_retry_backoff, max_backoff=job_max_backoff):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_run_at = None
+        self.last_error = None
+        self._lock = asyncio.Lock()
+        self._job_queue = None
+        self._next_job = None
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    @property
+    def active(self):
+        """Задача стоит в расписании этого процесса."""
+        return self._job_queue is not None
+
+    def start(self, job_queue, first_delay=0):
+        """Ставит первый запуск задачи в очередь заданий."""
+        self._job_queue = job_queue
+        self._schedule(first_delay)
+
+    def stop(self):
+        """Снимает задачу с расписания. Уже начатый запуск доработает, но следующий не будет запланирован."""
+        self._cancel_next_job()
+        self._next_job = None
+        self._job_queue = None
+
+    def _cancel_next_job(self):
+        if self._next_job is None:
+            return
+        try:
+            self._next_job.schedule_removal()
+        except KeyError:
+            pass  # задание уже сработало, и планировщик удалил его (JobLookupError)
+
+    def _schedule(self, delay):
+        self._next_job = self._job_queue.run_once(self._run_job, when=delay, name=self.name)
+
+    def next_delay(self):
+        """Задержка до следующего запуска с учетом ошибок подряд и случайного отклонения."""
+        if self.failures:
+            delay = min(self.max_backoff, self.retry_backoff * 2 ** (self.failures - 1))
+        else:
+            delay = self.interval() if callable(self.interval) else self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def run(self):
+        """Выполняет задачу, если она еще не выполняется. Возвращает False, если запуск пропущен."""
+        if self._lock.locked():
+            logging.info("Задача %s уже выполняется, запуск пропущен", self.name)
+            return False
+        async with self._lock:
+            started_at = time.monotonic()
+            try:
+                await self.func()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                job_runs.inc(self.name, 'error')
+                logging.exception("Ошибка в задаче %s (ошибок подряд: %s)", self.name, self.failures)
+            else:
+                self.failures = 0
+                self.last_error = None
+                job_runs.inc(self.name, 'ok')
+                logging.info("Задача %s выполнена за %.1f с", self.name, time.monotonic() - started_at)
+            finally:
+                self.last_run_at = time.time()
+                job_seconds.observe(time.monotonic() - started_at, self.name)
+        return True
+
+    async def _run_job(self, context):
+        if context.job is not self._next_job:
+            # Запуск заменен вызовом trigger, пока ждал своей очереди
+            return
+        try:
+            await self.run()
+        finally:
+            # Пока задача выполнялась, ее могли снять с расписания или запустить заново
+            if context.job is self._next_job and self._job_queue.scheduler.running:
+                self._schedule(self.next_delay())
 
+    def trigger(self):
+        """Запускает задачу вне расписания. Возвращает False, если она уже выполняется или не активна."""
+        if self.running or not self.active:
+            return False
+        self._cancel_next_job()
+        self._schedule(0)
+        return True
+
+
+scheduled_jobs = {}
+
+
+LEADER_JOBS = ('episodes', 'catalog')  # задачи, которые выполняет только ведущий процесс
+
+
+async def refresh_local_search_index():
+    """Перечитывает локальный поиск из базы в процессах, которые не обходят каталог.
+
+    Ведущий процесс обновляет индекс и кэш аниме сам при сохранении каталога.
+    Новый индекс строится отдельно и подменяет старый, чтобы поиск не ждал
+    перестроения, а закэшированные аниме получают названия и картинки из базы.
+    """
+    global local_search_index
+    if leader_election is not None and leader_election.is_leader:
+        return
+    anime_list = [(anime.anime_title, anime.anime_image, anime.anime_id) for anime in await db.aread(get_all_anime)]
+    search_index = TrigramSearchIndex()
+    await asyncio.to_thread(search_index.load, anime_list)
+    local_search_index = search_index
+    anime_cache.update(anime_list)
+
+
+def create_scheduled_jobs(job_queue):
+    """Создает периодические задачи бота и запускает те, что выполняются в каждом процессе."""
+    if job_queue is None:
+        raise RuntimeError("Очередь заданий недоступна: установите python-telegram-bot[job-queue]")
+    scheduled_jobs['episodes'] = ScheduledJob('episodes', front_page_poller.poll, front_page_poller.next_interval)
+    scheduled_jobs['catalog'] = ScheduledJob('catalog', update_anime_database, catalog_update_interval)
+    scheduled_jobs['search_index'] = ScheduledJob('search_index', refresh_local_search_index,
+                                                  search_index_refresh_interval)
+    scheduled_jobs['search_index'].start(job_queue, first_delay=search_index_refresh_interval)
+
+
+# --- Выбор ведущего процесса ---
+
+def acquire_lease(cursorThread, name, holder, ttl):
+    """Берет или продлевает аренду name. Возвращает True, если она принадлежит holder."""
+    now = time.time()
+    cursorThread.execute('''INSERT INTO leader_lease (name, holder, expires_at) VALUES (?, ?, ?)
+                            ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+                            WHERE leader_lease.holder=excluded.holder OR leader_lease.expires_at<?
+                            RETURNING holder''',
+                         (name, holder, now + ttl, now))
+    return cursorThread.fetchone() is not None
+
+
+def release_lease(cursorThread, name, holder):
+    """Освобождает аренду, чтобы другой процесс мог сразу ее забрать."""
+    cursorThread.execute("DELETE FROM leader_lease WHERE name=? AND holder=?", (name, holder))
+
+
+class LeaderElection:
+    """Выбирает один процесс бота, который обходит сайт и рассылает уведомления.
+
+    Процессы делят аренду в таблице leader_lease общей базы: ведущий продлевает
+    ее каждые ttl/3 секунд, остальные забирают ее, когда срок истек. При
+    получении роли вызывается on_elected, при потере (в том числе если аренду
+    не удалось продлить из-за ошибки базы) - on_demoted.
+    """
+
+    def __init__(self, on_elected, on_demoted, name='background', ttl=leader_lease_ttl):
+        self.name = name
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self.is_leader = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Прекращает участие в выборах и отдает роль, если она была у этого процесса."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self._set_leader(False)
+            await db.awrite(release_lease, self.name, self.holder)
+
+    async def _set_leader(self, is_leader):
+        self.is_leader = is_leader
+        if is_leader:
+            logging.info("Процесс %s стал ведущим", self.holder)
+            await self.on_elected()
+        else:
+            logging.info("Процесс %s больше не ведущий", self.holder)
+            await self.on_demoted()
+
+    async def _run(self):
+        while True:
+            try:
+                is_leader = await db.awrite(acquire_lease, self.name, self.holder, self.ttl)
+            except Exception as e:
+                logging.error(f"Не удалось продлить аренду ведущего процесса: {e}")
+                is_leader = False
+            if is_leader != self.is_leader:
+                try:
+                    await self._set_leader(is_leader)
+                except Exception:
+                    logging.exception("Ошибка при смене роли ведущего процесса")
+            await asyncio.sleep(self.ttl / 3)
+
+
+leader_election = None
+
+
+# --- Рассылка уведомлений ---
+
+class TokenBucket:
+    """Асинхронный token bucket: не больше rate операций в секунду, всплески до capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет и забирает один токен."""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                if self._updated_at is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def claim_notifications(cursorThread, limit, lease):
+    """Забирает из очереди уведомления, которые пора отправить.
+
+    Строки переводятся в статус sending на lease секунд: если бот упадет во время
+    отправки, после истечения аренды они снова попадут в рассылку.
+    Возвращает список (outbox_id, user_id, текст, номер попытки).
+    """
+    now = int(time.time())
+    cursorThread.execute('''UPDATE notification_outbox
+                            SET status='sending', attempts=attempts + 1, next_attempt_at=?
+                            WHERE outbox_id IN (
+                                SELECT outbox_id FROM notification_outbox
+                                WHERE status IN ('pending', 'sending') AND next_attempt_at<=?
+                                ORDER BY next_attempt_at LIMIT ?)
+                            RETURNING outbox_id''', (now + lease, now, limit))
+    outbox_ids = [row[0] for row in cursorThread.fetchall()]
+    if not outbox_ids:
+        return []
+
+    cursorThread.execute(
+        f'''SELECT notification_outbox.outbox_id, notification_outbox.user_id, anime.anime_title,
+                   episodes.episode_url, notification_outbox.attempts
+            FROM notification_outbox
+            INNER JOIN episodes ON episodes.episode_id = notification_outbox.episode_id
+            INNER JOIN anime ON anime.anime_id = episodes.anime_id
+            WHERE notification_outbox.outbox_id IN ({','.join('?' * len(outbox_ids))})''',
+        outbox_ids)
+    return [(outbox_id, user_id, f"Новая серия: {anime_title}\n{episode_url}", attempts)
+            for outbox_id, user_id, anime_title, episode_url, attempts in cursorThread.fetchall()]
+
+
+def mark_notification_sent(cursorThread, outbox_id):
+    """Отмечает уведомление отправленным."""
+    cursorThread.execute("UPDATE notification_outbox SET status='sent', sent_at=?, last_error=NULL WHERE outbox_id=?",
+                         (int(time.time()), outbox_id))
+
+
+def mark_notification_failed(cursorThread, outbox_id, error, retry_at=None):
+    """Записывает ошибку отправки. Без retry_at уведомление больше не отправляется."""
+    if retry_at is None:
+        cursorThread.execute("UPDATE notification_outbox SET status='failed', last_error=? WHERE outbox_id=?",
+                             (str(error), outbox_id))
+    else:
+        cursorThread.execute(
+            "UPDATE notification_outbox SET status='pending', last_error=?, next_attempt_at=? WHERE outbox_id=?",
+            (str(error), int(retry_at), outbox_id))
+
+
+def get_outbox_backlog(cursorThread):
+    """Возвращает количество уведомлений в очереди по статусам."""
+    cursorThread.execute("SELECT status, COUNT(*) FROM notification_outbox GROUP BY status")
+    return dict(cursorThread.fetchall())
+
+
+def purge_sent_notifications(cursorThread, max_age):
+    """Удаляет отправленные уведомления старше max_age секунд."""
+    cursorThread.execute("DELETE FROM notification_outbox WHERE status='sent' AND sent_at<?",
+                         (int(time.time()) - max_age,))
+
+
+async def update_outbox_metrics():
+    """Обновляет метрику размера очереди уведомлений."""
+    for status, count in (await db.aread(get_outbox_backlog)).items():
+        notification_backlog.set(count, status)
+
+
+class NotificationDispatcher:
+    """Рассылает уведомления из таблицы notification_outbox на цикле событий бота.
+
+    Очередь в базе разбирается пачками по batch_size, несколько воркеров
+    отправляют сообщения параллельно, соблюдая общий лимит Telegram (около 30
+    сообщений в секунду) и не чаще одного сообщения в per_chat_interval секунд
+    в один чат. Результат каждой отправки сразу записывается в базу. При
+    RetryAfter отправка ставится на паузу на указанное Telegram время, сетевые
+    ошибки повторяются с экспоненциальной задержкой через очередь в базе.
+    Уведомление, на отправку которого не дождались ответа (TimedOut), могло
+    уже дойти до пользователя, поэтому оно не повторяется, чтобы не прислать
+    его дважды, и остается в базе с ошибкой.
+    """
+
+    def __init__(self, bot, workers=notify_workers, rate_limit=notify_rate_limit,
+                 per_chat_interval=notify_per_chat_interval, max_attempts=notify_max_attempts,
+                 batch_size=notify_batch_size):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self._bucket = TokenBucket(rate_limit)
+        self._chat_slots = {}
+        self._resume_at = 0.0
+        self._queue = None
+        self._wakeup = None
+        self._loop = None
+        self._tasks = []
+
+    def start(self):
+        """Запускает воркеры и разбор очереди на текущем цикле событий."""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._drain()))
+
+    async def stop(self):
+        """Останавливает рассылку. Неотправленные уведомления остаются в базе."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self):
+        """Сообщает, что в очереди появились новые уведомления."""
+        self._wakeup.set()
+
+    async def _drain(self):
+        last_purge = 0.0
+        while True:
+            try:
+                batch = await db.awrite(claim_notifications, self.batch_size, notify_lease)
+                if not batch:
+                    if self._loop.time() - last_purge > 3600:
+                        last_purge = self._loop.time()
+                        await db.awrite(purge_sent_notifications, notify_sent_retention)
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), notify_poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                for item in batch:
+                    self._queue.put_nowait(item)
+                await self._queue.join()
+                backlog = await db.aread(get_outbox_backlog)
+                logging.info("Отправлено уведомлений: %s, в очереди: %s", len(batch), backlog.get('pending', 0))
+            except Exception as e:
+                # Ошибка одной итерации не должна останавливать рассылку
+                logging.error(f"Ошибка при разборе очереди уведомлений: {e}")
+                await asyncio.sleep(notify_poll_interval)
+
+    async def _worker(self):
+        while True:
+            outbox_id, chat_id, text, attempt = await self._queue.get()
+            try:
+                await self._send(outbox_id, chat_id, text, attempt)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке уведомления пользователю {chat_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _wait_for_chat(self, chat_id):
+        now = self._loop.time()
+        if len(self._chat_slots) > 10000:
+            self._chat_slots = {chat: slot for chat, slot in self._chat_slots.items() if slot > now}
+        slot = max(now, self._chat_slots.get(chat_id, 0.0))
+        self._chat_slots[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, outbox_id, chat_id, text, attempt):
+        while True:
+            await self._wait_for_chat(chat_id)
+            while (delay := self._resume_at - self._loop.time()) > 0:
+                await asyncio.sleep(delay)
+            await self._bucket.acquire()
+
+            try:
+                with notification_seconds.time():
+                    await self.bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                notifications.inc('rate_limited')
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                logging.warning("Telegram ограничил отправку, пауза %s с", retry_after)
+                self._resume_at = max(self._resume_at, self._loop.time() + retry_after)
+                continue
+            except (Forbidden, BadRequest) as e:
+                logging.info("Пользователь %s недоступен для уведомлений: %s", chat_id, e)
+                notifications.inc('blocked')
+                await db.awrite(mark_notification_failed, outbox_id, e)
+                return
+            except TimedOut as e:
+                logging.warning("Нет ответа на уведомление пользователю %s, возможно, оно доставлено: %s", chat_id, e)
+                notifications.inc('timed_out')
+                await db.awrite(mark_notification_failed, outbox_id, e)
+                return
+            except NetworkError as e:
+                if attempt >= self.max_attempts:
+                    logging.error(f"Не удалось отправить уведомление пользователю {chat_id}: {e}")
+                    notifications.inc('failed')
+                    await db.awrite(mark_notification_failed, outbox_id, e)
+                else:
+                    notifications.inc('retry')
+                    retry_at = time.time() + notify_retry_backoff * 2 ** (attempt - 1)
+                    await db.awrite(mark_notification_failed, outbox_id, e, retry_at)
+                return
+
+            notifications.inc('sent')
+            await db.awrite(mark_notification_sent, outbox_id)
+            return
+
+
+notification_dispatcher = None
 
-async def send_notification(user_id, title, url):
-    """Отправляет уведомление пользователю о новом аниме."""
-    async with application:  # Используем контекстный менеджер для доступа к боту
-        await application.bot.send_message(
-            chat_id=user_id,
-            text=f"Новая серия: {title}\n{url}"
-        )
+
+async def on_startup(app):
+    """Загружает локальный поиск, создает фоновые задачи и вступает в выборы ведущего процесса.
+
+    Обход сайта и рассылку уведомлений запускает только ведущий процесс.
+    """
+    global notification_dispatcher, leader_election
+    await asyncio.to_thread(load_local_search_index)
+    notification_dispatcher = NotificationDispatcher(app.bot)
+    create_scheduled_jobs(app.job_queue)
+
+    async def on_elected():
+        notification_dispatcher.start()
+        for name in LEADER_JOBS:
+            scheduled_jobs[name].start(app.job_queue)
+
+    async def on_demoted():
+        for name in LEADER_JOBS:
+            scheduled_jobs[name].stop()
+        await notification_dispatcher.stop()
+
+    leader_election = LeaderElection(on_elected, on_demoted)
+    leader_election.start()
+    app.bot_data['metrics_server'] = await start_metrics_server()
+
+
+async def on_shutdown(app):
+    """Отдает роль ведущего процесса, останавливает сервер метрик и закрывает соединения с сайтом и Elasticsearch."""
+    if leader_election is not None:
+        await leader_election.stop()
+    metrics_server = app.bot_data.get('metrics_server')
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await close_site_crawlers()
+    await es_async.close()
 
 
 # --- Elasticsearch ---
 
-def index_anime_data():
-    """Индексирует данные аниме в Elasticsearch."""
-    cursor.execute("SELECT * FROM anime")
-    anime_list = cursor.fetchall()
-
-    for anime in anime_list:
-        # Изменено: убран anime_hash из doc
-        doc = {
-            'anime_id': anime[0],
-            'anime_title': anime[1],
-            'anime_image': anime[2],
+def anime_document_hash(anime_title, anime_image):
+    """Хеш содержимого документа аниме в Elasticsearch."""
+    return hashlib.md5(f"{anime_title}\0{anime_image}".encode()).hexdigest()
+
+
+def anime_bulk_actions(anime_rows, index):
+    """Формирует действия bulk API для строк (anime_id, название, картинка)."""
+    for anime_id, anime_title, anime_image in anime_rows:
+        yield {
+            '_index': index,
+            '_id': anime_id,
+            '_source': {
+                'anime_id': anime_id,
+                'anime_title': anime_title,
+                'anime_image': anime_image,
+            },
         }
-        es.index(index='anime', id=anime[0], document=doc)
 
 
-async def search_anime(query: str):
-    """Выполняет нечеткий поиск аниме в Elasticsearch."""
+def get_all_anime(cursorThread):
+    """Возвращает все аниме как список AnimeRecord."""
+    cursorThread.execute("SELECT anime_id, anime_title, anime_image FROM anime")
+    return [AnimeRecord(*row) for row in cursorThread.fetchall()]
+
+
+def count_indexed_anime(cursorThread):
+    """Возвращает количество аниме, отправленных в Elasticsearch."""
+    cursorThread.execute("SELECT COUNT(*) FROM search_index_state")
+    return cursorThread.fetchone()[0]
+
+
+def get_anime_index_state(cursorThread):
+    """Возвращает (anime_id, название, картинка, хеш в Elasticsearch или None) для всех аниме."""
+    cursorThread.execute('''SELECT anime.anime_id, anime.anime_title, anime.anime_image, search_index_state.content_hash
+                            FROM anime LEFT JOIN search_index_state ON search_index_state.anime_id = anime.anime_id''')
+    return cursorThread.fetchall()
+
+
+def save_search_index_state(cursorThread, indexed, replace_all=False):
+    """Запоминает хеши проиндексированных аниме. С replace_all старое состояние удаляется."""
+    if replace_all:
+        cursorThread.execute("DELETE FROM search_index_state")
+    cursorThread.executemany("INSERT OR REPLACE INTO search_index_state (anime_id, content_hash) VALUES (?, ?)",
+                             indexed)
+
+
+def index_anime_data(full_reindex=False):
+    """Индексирует в Elasticsearch аниме, у которых изменились название или картинка.
+
+    Документы отправляются через bulk API пачками по es_bulk_chunk_size.
+    Хеш отправленного содержимого хранится в search_index_state, поэтому
+    неизменившиеся аниме повторно не индексируются. Если состояние пустое
+    или передан full_reindex, выполняется полная переиндексация.
+    Возвращает количество проиндексированных документов.
+    """
+    if full_reindex or db.read(count_indexed_anime) == 0:
+        return reindex_anime_data()
+
+    changed = {}
+    for anime_id, anime_title, anime_image, indexed_hash in db.read(get_anime_index_state):
+        content_hash = anime_document_hash(anime_title, anime_image)
+        if content_hash != indexed_hash:
+            changed[anime_id] = (anime_title, anime_image, content_hash)
+    if not changed:
+        return 0
+
+    indexed = []
+    rows = ((anime_id, title, image) for anime_id, (title, image, _) in changed.items())
+    for ok, info in helpers.streaming_bulk(es, anime_bulk_actions(rows, es_index),
+                                           chunk_size=es_bulk_chunk_size, raise_on_error=False):
+        if ok:
+            anime_id = int(info['index']['_id'])
+            indexed.append((anime_id, changed[anime_id][2]))
+        else:
+            logging.error(f"Ошибка при индексации аниме в Elasticsearch: {info}")
+
+    db.write(save_search_index_state, indexed)
+    logging.info("В Elasticsearch обновлено %s аниме из %s изменившихся", len(indexed), len(changed))
+    return len(indexed)
+
+
+def reindex_anime_data():
+    """Полностью переиндексирует аниме без простоя поиска.
+
+    Данные загружаются в новый индекс, после чего алиас es_index атомарно
+    переключается на него, а старые индексы удаляются. Обычный индекс с именем
+    es_index, оставшийся от прошлых версий бота, заменяется алиасом.
+    """
+    anime_rows = db.read(get_all_anime)
+
+    new_index = f"{es_index}_{int(time.time())}"
+    es.indices.create(index=new_index)
+    indexed, errors = helpers.bulk(es, anime_bulk_actions(anime_rows, new_index),
+                                   chunk_size=es_bulk_chunk_size, raise_on_error=False)
+    if errors:
+        es.indices.delete(index=new_index)
+        raise RuntimeError(f"Не удалось проиндексировать {len(errors)} аниме, алиас не переключен")
+    es.indices.refresh(index=new_index)
+
+    old_indices = []
+    actions = [{'add': {'index': new_index, 'alias': es_index}}]
+    if es.indices.exists_alias(name=es_index):
+        old_indices = list(es.indices.get_alias(name=es_index))
+        actions = [{'remove': {'index': index, 'alias': es_index}} for index in old_indices] + actions
+    elif es.indices.exists(index=es_index):
+        actions.insert(0, {'remove_index': {'index': es_index}})
+    es.indices.update_aliases(actions=actions)
+    for index in old_indices:
+        es.indices.delete(index=index)
+
+    db.write(save_search_index_state,
+             [(anime_id, anime_document_hash(anime_title, anime_image)) for anime_id, anime_title, anime_image in anime_rows],
+             True)
+    logging.info("Полная переиндексация: %s аниме в индексе %s", indexed, new_index)
+    return indexed
+
+
+async def search_anime_es(query: str, size=10):
+    """Выполняет нечеткий поиск аниме в Elasticsearch.
+
+    Возвращает None, если Elasticsearch недоступен, чтобы ошибка не попала в кэш поиска.
+    """
     try:
-        search_results = es.search(
-            index="anime",
-            body={
-                "query": {
-                    "bool": {  # Используем bool для комбинирования запросов
-                        "must": [  # Обязательное условие: совпадение по префиксу
-                            {
-                                "match_phrase_prefix": {
-                                    "anime_title": {
-                                        "query": query.lower(),
-                                        "slop": 2  # Допускаем до 2 перестановок слов
-                                    }
+        search_results = await es_async.search(
+            index=es_index,
+            size=size,
+            query={
+                "bool": {  # Используем bool для комбинирования запросов
+                    "must": [  # Обязательное условие: совпадение по префиксу
+                        {
+                            "match_phrase_prefix": {
+                                "anime_title": {
+                                    "query": query.lower(),
+                                    "slop": 2  # Допускаем до 2 перестановок слов
                                 }
                             }
-                        ],
-                        "should": [  # Желательное условие: нечеткое совпадение первых символов
-                            {
-                                "fuzzy": {
-                                    "anime_title": {
-                                        "value": query.lower(),
-                                        "fuzziness": 2,  # Максимальное количество опечаток: 1
-                                        "prefix_length": 3  # Не допускаем опечатки в первых 2 символах
-                                    }
+                        }
+                    ],
+                    "should": [  # Желательное условие: нечеткое совпадение первых символов
+                        {
+                            "fuzzy": {
+                                "anime_title": {
+                                    "value": query.lower(),
+                                    "fuzziness": 2,  # Максимальное количество опечаток: 1
+                                    "prefix_length": 3  # Не допускаем опечатки в первых 2 символах
                                 }
                             }
-                        ]
-                    }
+                        }
+                    ]
                 }
             }
         )
@@ -426,70 +2208,634 @@ async def search_anime(query: str):
         ]
     except Exception as e:
         logging.error(f"Ошибка при поиске в Elasticsearch: {e}")
-        return []  # Возвращаем пустой результат в случае ошибки
+        return None
+
+
+# --- Локальный поиск ---
+
+# Транслитерация кириллицы, чтобы "Наруто" и "naruto" давали одинаковые триграммы
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya',
+})
+NON_ALNUM_RE = re.compile(r'[^0-9a-z]+')
+
+
+def normalize_title(title):
+    """Приводит название к нижнему регистру латиницей, оставляя только буквы и цифры."""
+    return NON_ALNUM_RE.sub(' ', title.lower().translate(CYRILLIC_TO_LATIN)).strip()
+
+
+def title_trigrams(tokens, prefix_last=False):
+    """Триграммы слов с отступами по краям. Для prefix_last последнее слово считается началом слова."""
+    trigrams = set()
+    for i, token in enumerate(tokens):
+        padded = f"  {token}" if prefix_last and i == len(tokens) - 1 else f"  {token} "
+        trigrams.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return trigrams
+
+
+def bounded_levenshtein(a, b, max_distance):
+    """Расстояние Левенштейна, если оно не больше max_distance, иначе max_distance + 1.
+
+    Считается только полоса шириной max_distance вокруг диагонали.
+    """
+    too_far = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return too_far
+    previous = [j if j <= max_distance else too_far for j in range(len(b) + 1)]
+    for i, char_a in enumerate(a, start=1):
+        current = [too_far] * (len(b) + 1)
+        current[0] = row_min = i if i <= max_distance else too_far
+        for j in range(max(1, i - max_distance), min(len(b), i + max_distance) + 1):
+            distance = previous[j - 1] + (char_a != b[j - 1])
+            if previous[j] + 1 < distance:
+                distance = previous[j] + 1
+            if current[j - 1] + 1 < distance:
+                distance = current[j - 1] + 1
+            current[j] = distance
+            if distance < row_min:
+                row_min = distance
+        if row_min > max_distance:
+            return too_far
+        previous = current
+    return min(previous[-1], too_far)
+
+
+def token_matches(query_token, title_tokens, is_last):
+    """Совпадает ли слово запроса с каким-нибудь словом названия.
+
+    Последнее слово запроса может быть началом слова, как в match_phrase_prefix.
+    Опечатки допускаются, как в fuzzy-запросе Elasticsearch: до 1 в словах
+    до 5 букв и до 2 в более длинных, первые 3 буквы должны совпадать.
+    """
+    for title_token in title_tokens:
+        if query_token == title_token or (is_last and title_token.startswith(query_token)):
+            return True
+    if len(query_token) < 4:
+        return False
+
+    max_distance = 1 if len(query_token) <= 5 else 2
+    for title_token in title_tokens:
+        if query_token[:3] != title_token[:3]:
+            continue
+        if is_last:
+            title_token = title_token[:len(query_token)]
+        if bounded_levenshtein(query_token, title_token, max_distance) <= max_distance:
+            return True
+    return False
+
+
+class TrigramSearchIndex:
+    """Нечеткий поиск по названиям аниме в памяти процесса.
+
+    Названия нормализуются (регистр, ё, транслитерация кириллицы) и
+    раскладываются на триграммы. Для каждой триграммы хранится список слотов
+    в array('I'). Кандидаты отбираются по числу общих триграмм, затем каждое
+    слово запроса сверяется со словами названия с учетом префикса и опечаток.
+    Изменение названия добавляет новый слот и помечает старый удаленным;
+    индекс перестраивается, когда удаленных слотов становится слишком много.
+    """
+
+    max_candidates = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._ids = array('q')
+        self._titles = []
+        self._images = []
+        self._normalized = []
+        self._alive = bytearray()
+        self._postings = {}
+        self._slot_by_id = {}
+        self._dead = 0
+
+    def __len__(self):
+        return len(self._slot_by_id)
+
+    def load(self, anime_list):
+        """Строит индекс заново по списку (название, картинка, anime_id)."""
+        with self._lock:
+            self._clear()
+            for anime_title, anime_image, anime_id in anime_list:
+                self._add(anime_id, anime_title, anime_image)
+
+    def update(self, anime_list):
+        """Добавляет новые аниме и обновляет изменившиеся названия и картинки."""
+        with self._lock:
+            for anime_title, anime_image, anime_id in anime_list:
+                self._add(anime_id, anime_title, anime_image)
+            if self._dead > 1000 and self._dead * 4 > len(self._ids):
+                self._compact()
+
+    def _add(self, anime_id, anime_title, anime_image):
+        slot = self._slot_by_id.get(anime_id)
+        if slot is not None:
+            if self._titles[slot] == anime_title:
+                self._images[slot] = anime_image
+                return
+            self._alive[slot] = 0
+            self._dead += 1
+
+        slot = len(self._ids)
+        normalized = normalize_title(anime_title)
+        self._ids.append(anime_id)
+        self._titles.append(anime_title)
+        self._images.append(anime_image)
+        self._normalized.append(normalized)
+        self._alive.append(1)
+        self._slot_by_id[anime_id] = slot
+        for trigram in title_trigrams(normalized.split()):
+            postings = self._postings.get(trigram)
+            if postings is None:
+                postings = self._postings[trigram] = array('I')
+            postings.append(slot)
+
+    def _compact(self):
+        alive = [(self._titles[slot], self._images[slot], self._ids[slot])
+                 for slot in self._slot_by_id.values()]
+        self._clear()
+        for anime_title, anime_image, anime_id in alive:
+            self._add(anime_id, anime_title, anime_image)
+
+    def search(self, query, limit=10):
+        """Ищет аниме по запросу. Возвращает список словарей как search_anime_es."""
+        query_tokens = normalize_title(query).split()
+        if not query_tokens:
+            return []
+        normalized_query = ' '.join(query_tokens)
+        query_trigrams = title_trigrams(query_tokens, prefix_last=True)
+
+        with self._lock:
+            overlap = Counter()
+            for trigram in query_trigrams:
+                postings = self._postings.get(trigram)
+                if postings is not None:
+                    overlap.update(postings)
+
+            scored = []
+            last = len(query_tokens) - 1
+            # Слово с двумя опечатками теряет не больше двух третей своих триграмм
+            min_common = len(query_trigrams) / 3
+            for slot, common in overlap.most_common(self.max_candidates):
+                if common < min_common:
+                    break
+                # Кандидаты идут по убыванию общих триграмм: дальше оценка может быть только ниже
+                if len(scored) >= limit and common / len(query_trigrams) + 0.5 < -scored[limit - 1][0]:
+                    break
+                if not self._alive[slot]:
+                    continue
+                normalized = self._normalized[slot]
+                title_tokens = normalized.split()
+                if not all(token_matches(query_token, title_tokens, i == last)
+                           for i, query_token in enumerate(query_tokens)):
+                    continue
+                score = common / len(query_trigrams) + (0.5 if normalized.startswith(normalized_query) else 0)
+                scored.append((-score, len(normalized), slot))
+                scored.sort()
+            return [
+                {
+                    "id": self._ids[slot],
+                    "title": self._titles[slot],
+                    "image_url": self._images[slot],
+                }
+                for _, _, slot in scored[:limit]
+            ]
+
+
+local_search_index = TrigramSearchIndex()
+
+
+def load_local_search_index():
+    """Загружает названия аниме из базы в локальный поисковый индекс."""
+    started_at = time.monotonic()
+    local_search_index.load(
+        (anime.anime_title, anime.anime_image, anime.anime_id) for anime in db.read(get_all_anime))
+    logging.info("Локальный поисковый индекс загружен: %s аниме за %.3f с",
+                 len(local_search_index), time.monotonic() - started_at)
+
+
+async def search_anime_local(query: str, size=10):
+    """Выполняет нечеткий поиск аниме в локальном индексе."""
+    return local_search_index.search(query, size)
+
+
+search_backends = {
+    'elasticsearch': search_anime_es,
+    'local': search_anime_local,
+}
+
+
+async def search_anime(query: str, size=10):
+    """Ищет аниме в основном поисковом движке, а если он недоступен, в локальном индексе."""
+    with search_seconds.time(search_backend):
+        search_results = await search_backends[search_backend](query, size)
+    if search_results is None and search_backend != 'local':
+        search_errors.inc(search_backend)
+        logging.warning("Поиск %s недоступен, используем локальный индекс", search_backend)
+        with search_seconds.time('local'):
+            search_results = await search_anime_local(query, size)
+    return search_results
 
 
 # --- Обработчик инлайн-запросов ---
 
+class TTLCache:
+    """LRU-кэш с ограничением размера и временем жизни записей."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+search_cache = TTLCache(search_cache_size, search_cache_ttl)
+# Последний инлайн-запрос каждого пользователя: более ранние запросы не выполняются.
+# Словарь свой в каждом процессе: в режиме webhook с несколькими воркерами запросы
+# одного пользователя могут попасть в разные процессы, и тогда они не отменяют друг друга
+latest_inline_queries = {}
+
+
+def normalize_search_query(query):
+    """Приводит поисковый запрос к виду, используемому как ключ кэша."""
+    return ' '.join(query.lower().split())
+
+
+def parse_inline_offset(offset):
+    """Разбирает offset инлайн-запроса. Пустой или некорректный offset означает начало списка."""
+    try:
+        return max(0, int(offset))
+    except (TypeError, ValueError):
+        return 0
+
+
 async def inline_search_anime(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик инлайн-запросов."""
-    query = update.inline_query.query
+    """Обработчик инлайн-запросов.
+
+    Поиск выполняется один раз на запрос: до search_result_limit результатов
+    кэшируются по нормализованному запросу, а Telegram получает их страницами
+    по inline_page_size через offset и next_offset. Перед поиском нового
+    запроса обработчик ждет inline_search_debounce секунд и не выполняет его,
+    если пользователь за это время продолжил печатать. Кэш поиска и отмена
+    запросов работают в пределах одного процесса бота.
+    """
+    inline_query = update.inline_query
+    query = normalize_search_query(inline_query.query)
 
     if not query:
         return
 
-    search_results = await search_anime(query)
-    if search_results:
+    offset = parse_inline_offset(inline_query.offset)
+    user_id = inline_query.from_user.id
+    latest_inline_queries[user_id] = inline_query.id
+    try:
+        search_results = search_cache.get(query)
+        if search_results is None:
+            if offset == 0:
+                await asyncio.sleep(inline_search_debounce)
+                if latest_inline_queries.get(user_id) != inline_query.id:
+                    return  # Пользователь уже ввел более новый запрос
+
+            search_results = await search_anime(query, search_result_limit)
+            if search_results is None:
+                return
+            search_cache.set(query, search_results)
+
+        if latest_inline_queries.get(user_id) != inline_query.id:
+            return
+    finally:
+        if latest_inline_queries.get(user_id) == inline_query.id:
+            del latest_inline_queries[user_id]
+
+    page = search_results[offset:offset + inline_page_size]
+    if page:
         results = [
             InlineQueryResultArticle(
                 id=result['id'],
                 title=result['title'],
-                thumbnail_url=result.get('image_url', ''),  # URL маленькой картинки (можно тот же)
+                thumbnail_url=result.get('image_url') or None,  # URL маленькой картинки (можно тот же)
                 description=f"Нажмите, чтобы подписаться на {result['title']}",
                 input_message_content=InputTextMessageContent(
                     message_text=f"/anime {result['id']}"  # Используем команду /anime
                 ),
             )
-            for result in search_results
+            for result in page
         ]
-        await update.inline_query.answer(results)
+        next_offset = offset + inline_page_size
+        # Результаты одинаковы для всех пользователей, поэтому Telegram может кэшировать их у себя
+        await inline_query.answer(results, cache_time=inline_cache_time, is_personal=False,
+                                  next_offset=str(next_offset) if next_offset < len(search_results) else '')
 
 
 # Новый обработчик команды /anime
 async def handle_anime_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает команду /anime <anime_id>."""
-    anime_id = context.args[0]  # Получаем anime_id из аргументов команды
+    try:
+        anime_id = int(context.args[0])  # Получаем anime_id из аргументов команды
+    except (IndexError, ValueError):
+        await update.effective_message.reply_text("Использование: /anime <id>")
+        return
 
     # Получаем информацию об аниме
-    anime_title = get_anime_title_by_id(anime_id)
-    anime_image = get_anime_image_by_id(anime_id)
+    anime = await get_anime_cached(anime_id)
+    if anime is None:
+        await update.effective_message.reply_text("Ошибка: не удалось найти аниме.")
+        return
 
     # Создаем кнопку "Подписаться"
     keyboard = InlineKeyboardMarkup(
         [[InlineKeyboardButton("Подписаться", callback_data=f"subscribe_{anime_id}")]]
     )
-    str = f"Выбранное аниме: {anime_title}"
+    str = f"Выбранное аниме: {anime.anime_title}"
     # Отправляем сообщение с картинкой и кнопкой
     await context.bot.send_photo(
         chat_id=update.effective_user.id,
-        photo=anime_image,
+        photo=anime.anime_image,
         caption=str,
         reply_markup=keyboard,
     )
 
 
+async def refresh_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает команду администратора /refresh [episodes|catalog|search_index|reindex].
+
+    reindex запускает обновление каталога с полной переиндексацией Elasticsearch.
+    """
+    global es_full_reindex_requested
+    if update.effective_user.id not in admin_user_ids:
+        await update.effective_message.reply_text("Команда доступна только администраторам.")
+        return
+
+    names = context.args or list(LEADER_JOBS)
+    unknown = [name for name in names if name not in scheduled_jobs and name != 'reindex']
+    if unknown:
+        await update.effective_message.reply_text(f"Использование: /refresh [{'|'.join(scheduled_jobs)}|reindex]")
+        return
+
+    lines = []
+    for name in names:
+        if name == 'reindex' and search_backend != 'elasticsearch':
+            lines.append(f"{name}: поиск работает без Elasticsearch")
+            continue
+        job = scheduled_jobs['catalog' if name == 'reindex' else name]
+        if not job.active:
+            # В режиме webhook команду мог получить ведомый процесс
+            lines.append(f"{name}: выполняется в ведущем процессе, повторите команду")
+            continue
+        if name == 'reindex':
+            es_full_reindex_requested = True
+        if job.trigger():
+            lines.append(f"{name}: запущено")
+        elif name == 'reindex':
+            lines.append(f"{name}: выполнится в текущем или следующем обновлении каталога")
+        else:
+            lines.append(f"{name}: уже выполняется")
+        if job.last_error:
+            lines.append(f"  последняя ошибка: {job.last_error}")
+    await update.effective_message.reply_text("\n".join(lines))
+
+
+def format_latency_stats(histogram, limit=None):
+    """Строки вида "метка: число, p50, p99" для гистограммы, самые частые первыми."""
+    samples = sorted(histogram.samples(), key=lambda sample: sample[3], reverse=True)[:limit]
+    lines = []
+    for labels, _, _, count in samples:
+        p50 = histogram.quantile(0.5, *labels) * 1000
+        p99 = histogram.quantile(0.99, *labels) * 1000
+        lines.append(f"  {'/'.join(labels) or 'все'}: {count}, p50 ≤ {p50:g} мс, p99 ≤ {p99:g} мс")
+    return lines or ["  нет данных"]
+
+
+def format_counter_stats(counter, empty="нет"):
+    """Значения счетчика одной строкой: "метка число, ..."."""
+    return ", ".join(f"{'/'.join(labels)} {value}" for labels, value in counter.samples()) or empty
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает команду администратора /stats: сводка метрик бота."""
+    if update.effective_user.id not in admin_user_ids:
+        await update.effective_message.reply_text("Команда доступна только администраторам.")
+        return
+
+    await update_outbox_metrics()
+    uptime = int(time.time() - metrics.started_at)
+    lines = [f"Работает {uptime // 3600} ч {uptime % 3600 // 60} мин", "Обработчики (число, задержка):"]
+    lines += format_latency_stats(handler_seconds)
+    lines.append(f"Ошибки обработчиков: {format_counter_stats(handler_errors)}")
+    lines += ["Запросы к animy.org:"] + format_latency_stats(http_request_seconds)
+    lines += ["Поиск:"] + format_latency_stats(search_seconds)
+    lines += ["База данных (самые частые):"] + format_latency_stats(db_query_seconds, limit=8)
+    lines += ["Фоновые задачи:"] + format_latency_stats(job_seconds)
+    lines.append(f"Уведомления: {format_counter_stats(notifications)}")
+    lines.append(f"Очередь уведомлений: {format_counter_stats(notification_backlog, 'пусто')}")
+    await update.effective_message.reply_text("\n".join(lines))
+
+
+# Инициализация бота
+bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+if not bot_token:
+    print("Ошибка: переменная окружения TELEGRAM_BOT_TOKEN не установлена.")
+    exit(1)
+application = ApplicationBuilder().token(bot_token).post_init(on_startup).post_shutdown(on_shutdown).build()
+
+
+def add_handlers(app):
+    """Регистрирует обработчики команд, кнопок и инлайн-запросов."""
+    app.add_handler(CommandHandler("start", instrument_handler(start)))
+    app.add_handler(CallbackQueryHandler(instrument_handler(button_clicked)))
+    # Инлайн-запросы обрабатываются параллельно, чтобы ожидание дребезга не задерживало другие обновления
+    app.add_handler(InlineQueryHandler(instrument_handler(inline_search_anime), block=False))  # <--  Обработчик инлайн-режима
+    app.add_handler(CommandHandler("anime", instrument_handler(handle_anime_command)))
+    app.add_handler(CommandHandler("refresh", refresh_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+
+
+# --- Режим вебхука ---
+
+def webhook_path():
+    return urllib.parse.urlsplit(webhook_url).path or '/'
+
+
+async def handle_webhook_request(app, method, path, headers, body):
+    """Ставит обновление из запроса Telegram в очередь приложения. Возвращает HTTP-статус."""
+    if path.split('?')[0] != webhook_path():
+        return '404 Not Found'
+    if method != 'POST':
+        return '405 Method Not Allowed'
+    if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), webhook_secret):
+        return '403 Forbidden'
+    try:
+        update = Update.de_json(json.loads(body), app.bot)
+    except (ValueError, TypeError, KeyError) as e:
+        logging.warning(f"Некорректное обновление в вебхуке: {e}")
+        return '400 Bad Request'
+    await app.update_queue.put(update)
+    return '200 OK'
+
+
+async def serve_webhook_connection(app, reader, writer):
+    """Обслуживает соединение Telegram с вебхуком (HTTP/1.1 с keep-alive)."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            headers = {}
+            while (line := await reader.readline()).strip():
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            parts = request_line.decode('latin-1').split()
+            content_length = int(headers.get('content-length', 0))
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            if len(parts) < 2:
+                status, keep_alive = '400 Bad Request', False
+            elif content_length > webhook_max_body:
+                status, keep_alive = '413 Payload Too Large', False
+            else:
+                body = await reader.readexactly(content_length)
+                status = await handle_webhook_request(app, parts[0], parts[1], headers, body)
+            webhook_requests.inc(status.split()[0])
+
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+                         f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode())
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_webhook(app):
+    """Принимает обновления на webhook_port, пока процесс не получит SIGTERM или SIGINT.
+
+    Сокет открывается с SO_REUSEPORT, поэтому несколько процессов слушают один
+    порт, а ядро распределяет между ними соединения Telegram.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_event.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    server = await asyncio.start_server(functools.partial(serve_webhook_connection, app),
+                                        webhook_listen, webhook_port, reuse_port=True)
+    logging.info("Процесс %s принимает обновления на %s:%s%s", os.getpid(), webhook_listen, webhook_port,
+                 webhook_path())
+    try:
+        await stop_event.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+
+def run_webhook_worker(worker_index):
+    """Точка входа процесса, принимающего обновления через вебхук."""
+    global metrics_port
+    if metrics_port:
+        metrics_port += worker_index  # у каждого процесса свой порт метрик
+    add_handlers(application)
+    asyncio.run(serve_webhook(application))
+
+
+async def set_webhook():
+    """Регистрирует адрес вебхука и секрет в Telegram."""
+    async with application.bot:
+        await application.bot.set_webhook(webhook_url, secret_token=webhook_secret,
+                                          max_connections=webhook_max_connections,
+                                          allowed_updates=Update.ALL_TYPES)
+
+
+def run_webhook():
+    """Регистрирует вебхук и запускает bot_workers процессов, принимающих обновления на одном порту.
+
+    Упавший процесс перезапускается. Фоновые задачи выполняет только процесс,
+    выбранный ведущим через аренду в базе.
+    """
+    global webhook_secret
+    if not webhook_url:
+        print("Ошибка: для режима webhook нужна переменная окружения WEBHOOK_URL.")
+        exit(1)
+    if not webhook_secret:
+        webhook_secret = secrets.token_urlsafe(32)
+        os.environ['WEBHOOK_SECRET'] = webhook_secret  # процессы-обработчики читают секрет из окружения
+    asyncio.run(set_webhook())
+
+    if bot_workers <= 1:
+        run_webhook_worker(0)
+        return
+
+    # spawn: процессы не наследуют открытые соединения с базой и потоки родителя
+    process_context = multiprocessing.get_context('spawn')
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    def start_worker(worker_index):
+        process = process_context.Process(target=run_webhook_worker, args=(worker_index,),
+                                          name=f"bot-worker-{worker_index}")
+        process.start()
+        return process
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    workers = {worker_index: start_worker(worker_index) for worker_index in range(bot_workers)}
+    logging.info("Запущено процессов-обработчиков: %s", bot_workers)
+    while not stopping:
+        time.sleep(1)
+        for worker_index, process in workers.items():
+            if not process.is_alive() and not stopping:
+                logging.error("Процесс-обработчик %s завершился с кодом %s, перезапуск",
+                              worker_index, process.exitcode)
+                workers[worker_index] = start_worker(worker_index)
+
+    for process in workers.values():
+        process.terminate()
+    for process in workers.values():
+        process.join(30)
+
+
 # --- Запуск бота ---
 
 if __name__ == '__main__':
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_clicked))
-    application.add_handler(InlineQueryHandler(inline_search_anime))  # <--  Обработчик инлайн-режима
-    application.add_handler(CommandHandler("anime", handle_anime_command))
-
     logging.info("Запуск бота...")
-    # Запуск проверки обновлений в отдельном потоке
-    threading.Thread(target=check_updates_and_notify, daemon=True).start()
-    # Запуск обновления базы данных в отдельном потоке
-    threading.Thread(target=update_anime_database, daemon=True).start()
-
-    application.run_polling()
\ No newline at end of file
+    # Фоновые задачи и рассылка уведомлений запускаются в on_startup
+    if bot_mode == 'webhook':
+        run_webhook()
+    else:
+        add_handlers(application)
+        application.run_polling()
\ No newline at end of file
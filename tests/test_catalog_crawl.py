@@ -0,0 +1,144 @@
+"""Проверки обхода каталога и кэша его страниц на заменителе animy.org.
+
+Запуск: python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:test')
+os.environ['ANIME_BOT_DB'] = os.path.join(tempfile.mkdtemp(prefix='anime_bot_test_'), 'bot.db')
+os.environ['ANIMY_URL'] = 'https://animy.test'
+os.environ['CRAWLER_RATE_LIMIT'] = '1000'
+os.environ['PARSE_WORKERS'] = '0'
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+PAGE_SIZE = 6
+AsyncClient = httpx.AsyncClient
+
+
+class FakeSite:
+    """Каталог из pages страниц по PAGE_SIZE аниме, новые релизы встают в начало."""
+
+    def __init__(self, pages, pager_window=None):
+        self.pages = pages
+        self.pager_window = pager_window
+        self.titles = list(range(pages * PAGE_SIZE))
+
+    def release(self, title):
+        """Ставит аниме в начало каталога, остальные сдвигаются, последнее выпадает."""
+        if title in self.titles:
+            self.titles.remove(title)
+        else:
+            self.titles.pop()
+        self.titles.insert(0, title)
+
+    def releases_page(self, page_num):
+        first = (page_num - 1) * PAGE_SIZE
+        cards = ''.join(f'<a href="https://animy.test/releases/item/t{i}"><img src="https://img/{i}.jpg">'
+                        f'<h2>Аниме {i}</h2></a>' for i in self.titles[first:first + PAGE_SIZE])
+        last_link = self.pages if self.pager_window is None else min(self.pages, page_num + self.pager_window)
+        pager = ''.join(f'<a href="https://animy.test/releases/page/{num}">{num}</a>'
+                        for num in range(1, last_link + 1))
+        next_link = '<span class="num_right">»</span>' if page_num < self.pages else ''
+        return (f'<html><body><div class="releases-main">{cards}</div>'
+                f'<div class="pager">{pager}{next_link}</div></body></html>')
+
+    def handler(self, request):
+        page_num = int(request.url.path.rsplit('/', 1)[1])
+        if page_num > self.pages:
+            return httpx.Response(404)
+        return httpx.Response(200, text=self.releases_page(page_num))
+
+    def client(self, **kwargs):
+        kwargs.pop('limits', None)
+        return AsyncClient(transport=httpx.MockTransport(self.handler), **kwargs)
+
+
+def get_catalog_state(cursorThread):
+    cursorThread.execute("SELECT page_num FROM catalog_pages ORDER BY page_num")
+    page_nums = [page_num for page_num, in cursorThread.fetchall()]
+    cursorThread.execute("SELECT COUNT(*) FROM anime WHERE catalog_page IS NOT NULL")
+    return page_nums, cursorThread.fetchone()[0]
+
+
+def clear_catalog(cursorThread):
+    cursorThread.execute("DELETE FROM catalog_pages")
+    cursorThread.execute("DELETE FROM anime")
+
+
+class CatalogCrawlTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        await main.db.awrite(clear_catalog)
+
+    async def asyncTearDown(self):
+        await main.close_site_crawlers()
+
+    async def use_site(self, site):
+        # Краулеры создаются заново, уже с клиентом к новому сайту
+        await main.close_site_crawlers()
+        patcher = mock.patch.object(main.httpx, 'AsyncClient', site.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_full_crawl_after_incremental_refresh_keeps_catalog(self):
+        # Новая серия старого аниме меняет только первую страницу, новые аниме - первые две
+        for releases, fetched_pages in (([20], 1), ([100, 101], 2)):
+            with self.subTest(releases=releases):
+                await main.db.awrite(clear_catalog)
+                site = FakeSite(pages=6)
+                await self.use_site(site)
+                await main.crawl_anime_catalog()
+                self.assertEqual(await main.db.aread(get_catalog_state), ([1, 2, 3, 4, 5, 6], 36))
+
+                for title in releases:
+                    site.release(title)
+                self.assertEqual(await main.refresh_new_anime(), fetched_pages)
+                self.assertEqual((await main.db.aread(get_catalog_state))[0], [1, 2, 3, 4, 5, 6])
+                self.assertIsNone(await main.db.aread(main.get_cached_anime_page, fetched_pages + 1))
+
+                await main.crawl_anime_catalog()
+                self.assertEqual(await main.db.aread(get_catalog_state), ([1, 2, 3, 4, 5, 6], 36))
+
+    async def test_full_crawl_follows_next_link_past_pager_window(self):
+        # Пагинатор показывает только две страницы вперед
+        await self.use_site(FakeSite(pages=8, pager_window=2))
+        for _ in range(2):
+            await main.crawl_anime_catalog()
+            self.assertEqual(await main.db.aread(get_catalog_state), ([1, 2, 3, 4, 5, 6, 7, 8], 48))
+
+    async def test_crawl_without_pager_is_sequential(self):
+        await self.use_site(FakeSite(pages=3, pager_window=0))
+        self.assertEqual(await main.crawl_anime_catalog(), 3)
+        self.assertEqual(await main.db.aread(get_catalog_state), ([1, 2, 3], 18))
+
+    async def test_stale_page_is_loaded_from_site(self):
+        site = FakeSite(pages=3)
+        await self.use_site(site)
+        await main.crawl_anime_catalog()
+        site.release(100)
+        await main.refresh_new_anime()
+
+        anime_list, has_next_page = await main.load_anime_page(3)
+        self.assertFalse(has_next_page)
+        self.assertEqual(len(anime_list), PAGE_SIZE)
+        self.assertEqual(await main.db.aread(main.get_cached_anime_page, 3), (anime_list, False))
+
+    async def test_background_jobs_share_one_client(self):
+        await self.use_site(FakeSite(pages=2))
+        await main.crawl_anime_catalog()
+        crawler = main.get_background_crawler()
+        await main.refresh_new_anime()
+        self.assertIs(main.get_background_crawler(), crawler)
+        await main.close_site_crawlers()
+        self.assertIsNone(main.background_crawler)
+
+if __name__ == '__main__':
+    unittest.main()